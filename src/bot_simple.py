@@ -1,5 +1,10 @@
+import asyncio
+import codecs
 import os
+import tempfile
 import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from src.document_store_simple import DocumentStore  # Using simplified version
@@ -11,6 +16,11 @@ from utils.cache_manager import CacheManager
 from utils.conversation_manager import ConversationManager
 from utils.query_router import QueryRouter
 
+try:
+    import charset_normalizer
+except ImportError:
+    charset_normalizer = None
+
 load_dotenv()
 
 class UniversityDocumentBot:
@@ -18,16 +28,19 @@ class UniversityDocumentBot:
         self.logger = setup_logger("telegram_bot")
         self.document_store = DocumentStore()
         self.openai_service = OpenAIService()
-        self.cache_manager = CacheManager(ttl=3600)
-        self.conversation_manager = ConversationManager(max_history=10)
+        self.cache_manager = CacheManager.get_shared(ttl=3600)
+        self.conversation_manager = ConversationManager.get_shared(max_history=10)
         self.query_router = QueryRouter()
+        self.pdf_extractor = PDFExtractor()
         self.token = os.getenv("TELEGRAM_BOT_TOKEN")
+        # Updates are handled concurrently; per-user locks keep each user's history and cache writes ordered
+        self.user_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
 
         if not self.token:
             self.logger.error("TELEGRAM_BOT_TOKEN не найден в переменных окружения!")
             raise ValueError("TELEGRAM_BOT_TOKEN не найден в переменных окружения!")
 
-        self.application = Application.builder().token(self.token).build()
+        self.application = Application.builder().token(self.token).concurrent_updates(True).build()
         self._setup_handlers()
         self.logger.info("Бот успешно инициализирован")
     
@@ -40,8 +53,8 @@ class UniversityDocumentBot:
         self.application.add_handler(CommandHandler("delete", self.delete_document))
         self.application.add_handler(CommandHandler("clear", self.clear_history))
         self.application.add_handler(CommandHandler("routing", self.explain_routing))
-        self.application.add_handler(MessageHandler(filters.Document.ALL, self.handle_document))
-        self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
+        self.application.add_handler(MessageHandler(filters.Document.ALL, self.handle_document, block=False))
+        self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message, block=False))
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handler for /start command"""
@@ -148,7 +161,8 @@ class UniversityDocumentBot:
         
         try:
             doc_id = str(uuid.uuid4())
-            success = self.document_store.add_document(
+            success = await asyncio.to_thread(
+                self.document_store.add_document,
                 document_id=doc_id,
                 title=title,
                 full_text=text,
@@ -211,8 +225,9 @@ class UniversityDocumentBot:
 
         self.logger.info(f"Пользователь {username} (ID: {user_id}) запустил команду /clear")
 
-        stats = self.conversation_manager.get_stats(user_id)
-        success = self.conversation_manager.clear_history(user_id)
+        async with self.user_locks[user_id]:
+            stats = self.conversation_manager.get_stats(user_id)
+            success = self.conversation_manager.clear_history(user_id)
 
         if success and stats['total_messages'] > 0:
             await update.message.reply_text(
@@ -260,6 +275,29 @@ class UniversityDocumentBot:
             )
             await update.message.reply_text(info_text)
 
+    @staticmethod
+    def _decode_text(file_bytes: bytes) -> str:
+        """Decodes an uploaded text file, choosing the encoding from an 8 KB prefix; the whole file is decoded strictly,
+        so one decode suffices for valid files and a wrong guess falls back instead of dropping characters"""
+        prefix = file_bytes[:8192]
+        encoding = None
+        try:
+            # Incremental decoding tolerates a multi-byte character cut off at the end of the prefix
+            codecs.getincrementaldecoder('utf-8')().decode(prefix, final=False)
+            encoding = 'utf-8'
+        except UnicodeDecodeError:
+            if charset_normalizer is not None:
+                detected = charset_normalizer.detect(prefix)
+                # Low-confidence guesses on short texts tend to pick exotic code pages
+                if detected['encoding'] and (detected['confidence'] or 0) >= 0.9:
+                    encoding = detected['encoding']
+        for candidate in dict.fromkeys((encoding or 'windows-1251', 'windows-1251')):
+            try:
+                return file_bytes.decode(candidate)
+            except (UnicodeDecodeError, LookupError):
+                continue
+        return file_bytes.decode('utf-8', errors='ignore')
+
     async def handle_document(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handler for document uploads (supports TXT and PDF)"""
         user_id = update.effective_user.id
@@ -272,17 +310,22 @@ class UniversityDocumentBot:
         file_type = "PDF" if filename.lower().endswith('.pdf') else "текстовый файл"
         await update.message.reply_text(f"⏳ Обрабатываю {file_type}...")
 
+        tmp_path = None
         try:
+            # The upload is streamed to a temp file instead of being held in memory as bytearray + bytes copies
             file = await context.bot.get_file(document.file_id)
-            file_content = await file.download_as_bytearray()
-            file_bytes = bytes(file_content)
+            fd, tmp_path = tempfile.mkstemp(suffix=os.path.splitext(filename)[1])
+            os.close(fd)
+            await file.download_to_drive(tmp_path)
+            with open(tmp_path, 'rb') as f:
+                header = f.read(5)
 
             text = None
-            pdf_extractor = PDFExtractor()
+            is_pdf = PDFExtractor.is_pdf(header, filename)
 
-            if PDFExtractor.is_pdf(file_bytes, filename):
+            if is_pdf:
                 await update.message.reply_text("📄 Извлекаю текст из PDF...")
-                text = pdf_extractor.extract_text_from_pdf(file_bytes)
+                text = await asyncio.to_thread(self.pdf_extractor.extract_text_from_path, tmp_path)
 
                 if text is None or not text.strip():
                     await update.message.reply_text(
@@ -295,13 +338,9 @@ class UniversityDocumentBot:
                     f"✅ Извлечено {text_length} символов из PDF. Обрабатываю..."
                 )
             else:
-                try:
-                    text = file_bytes.decode('utf-8')
-                except UnicodeDecodeError:
-                    try:
-                        text = file_bytes.decode('windows-1251')
-                    except UnicodeDecodeError:
-                        text = file_bytes.decode('utf-8', errors='ignore')
+                with open(tmp_path, 'rb') as f:
+                    file_bytes = f.read()
+                text = self._decode_text(file_bytes)
             
             if not text or not text.strip():
                 await update.message.reply_text(
@@ -314,7 +353,8 @@ class UniversityDocumentBot:
                 title = title.rsplit('.', 1)[0]
 
             doc_id = str(uuid.uuid4())
-            success = self.document_store.add_document(
+            success = await asyncio.to_thread(
+                self.document_store.add_document,
                 document_id=doc_id,
                 title=title,
                 full_text=text,
@@ -322,7 +362,7 @@ class UniversityDocumentBot:
             )
             
             if success:
-                file_type_emoji = "📕" if PDFExtractor.is_pdf(file_bytes, filename) else "📄"
+                file_type_emoji = "📕" if is_pdf else "📄"
                 await update.message.reply_text(
                     f"✅ Документ успешно загружен!\n\n"
                     f"{file_type_emoji} Название: {title}\n"
@@ -340,7 +380,30 @@ class UniversityDocumentBot:
                 f"❌ Произошла ошибка при обработке документа: {str(e)}\n\n"
                 f"Убедись, что файл в поддерживаемом формате (TXT или PDF)."
             )
+        finally:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
     
+    async def _select_relevant_chunks(self, doc: Dict, query: str, query_embedding: List[float]) -> Optional[List[Tuple[str, int]]]:
+        """Returns (chunk, token count) for the most relevant chunks of a long document, or None if the full text fits as is"""
+        full_text = doc.get('full_text', '')
+        if len(full_text) < 5000:
+            return None
+
+        chunk_index = doc.get('chunk_index')
+        if chunk_index and query_embedding:
+            return self.document_store.search_chunks(chunk_index, query_embedding, top_k=2)
+
+        # Documents added before chunk indexing fall back to keyword scoring
+        chunks = await asyncio.to_thread(
+            self.openai_service.extract_relevant_chunks,
+            full_text,
+            query,
+            max_chunks=2,
+            chunk_size=1500
+        )
+        return [(chunk, self.openai_service.estimate_tokens(chunk)) for chunk in chunks]
+
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handler for text messages (user questions)"""
         user_id = update.effective_user.id
@@ -374,11 +437,16 @@ class UniversityDocumentBot:
                 f"threshold={routing_result['similarity_threshold']}"
             )
 
-            relevant_docs = self.document_store.search_documents(
+            # The query embedding is shared by document search and the semantic answer cache.
+            # Both calls block on network/disk, so keep them off the event loop
+            query_embedding = await asyncio.to_thread(self.openai_service.get_embedding, query)
+            relevant_docs = await asyncio.to_thread(
+                self.document_store.search_documents,
                 query,
                 user_id,
                 top_k=routing_result['top_k'],
-                similarity_threshold=routing_result['similarity_threshold']
+                similarity_threshold=routing_result['similarity_threshold'],
+                query_embedding=query_embedding
             )
             
             if not relevant_docs:
@@ -392,27 +460,36 @@ class UniversityDocumentBot:
             max_tokens_per_doc = 10000
             max_total_tokens = 60000
             
+            # Chunk selection for all long documents runs concurrently; token budgeting below stays sequential
+            chunk_results = await asyncio.gather(
+                *[self._select_relevant_chunks(doc, query, query_embedding) for doc in relevant_docs]
+            )
+
             total_tokens = 0
-            for doc in relevant_docs:
+            for doc, relevant_chunks in zip(relevant_docs, chunk_results):
                 if total_tokens >= max_total_tokens:
                     break
 
                 doc_summary = doc.get('summary', '')
                 full_text = doc.get('full_text', '')
 
-                if len(full_text) < 5000:
+                # Summary/text/chunk token counts are precomputed by the store, so the assembled context is not re-tokenized
+                summary_tokens = doc.get('summary_tokens')
+                if summary_tokens is None:
+                    summary_tokens = self.openai_service.estimate_tokens(doc_summary)
+
+                if relevant_chunks is None:
                     doc_context = f"Документ: {doc['title']}\nРезюме: {doc_summary}\n\nСодержание:\n{full_text}"
+                    body_tokens = doc.get('text_tokens')
+                    if body_tokens is None:
+                        body_tokens = self.openai_service.estimate_tokens(full_text)
                 else:
-                    relevant_chunks = self.openai_service.extract_relevant_chunks(
-                        full_text,
-                        query,
-                        max_chunks=2,
-                        chunk_size=1500
-                    )
-                    chunks_text = "\n\n".join([f"[Часть {i+1}]\n{chunk}" for i, chunk in enumerate(relevant_chunks)])
+                    chunks_text = "\n\n".join([f"[Часть {i+1}]\n{chunk}" for i, (chunk, _) in enumerate(relevant_chunks)])
                     doc_context = f"Документ: {doc['title']}\nРезюме: {doc_summary}\n\nРелевантные части:\n{chunks_text}"
+                    body_tokens = sum(chunk_tokens for _, chunk_tokens in relevant_chunks) + 5 * len(relevant_chunks)
 
-                doc_tokens = self.openai_service.estimate_tokens(doc_context)
+                # Labels ("Документ:", "Резюме:", ...) add about 10 tokens on top of the title
+                doc_tokens = self.openai_service.estimate_tokens(doc['title']) + summary_tokens + body_tokens + 10
                 if doc_tokens > max_tokens_per_doc:
                     doc_context = self.openai_service.truncate_text(doc_context, max_tokens_per_doc)
                     doc_tokens = max_tokens_per_doc
@@ -425,28 +502,33 @@ class UniversityDocumentBot:
                     if remaining_tokens > 1000:
                         partial_context = self.openai_service.truncate_text(doc_context, remaining_tokens)
                         context_parts.append(partial_context + "\n[Документ обрезан из-за ограничения размера]")
+                        total_tokens = max_total_tokens
                     break
 
             context = "\n\n---\n\n".join(context_parts)
-            conversation_history = self.conversation_manager.get_history(user_id, limit=6)
 
-            cached_answer = self.cache_manager.get(query, context, user_id)
-            if cached_answer:
-                self.logger.info(f"Возвращен кэшированный ответ для пользователя {user_id}")
-                answer = cached_answer
-                is_cached = True
-            else:
-                answer = self.openai_service.generate_answer(
-                    query,
-                    context,
-                    conversation_history=conversation_history,
-                    max_context_tokens=60000
-                )
-                self.cache_manager.set(query, context, user_id, answer)
-                is_cached = False
+            async with self.user_locks[user_id]:
+                conversation_history = self.conversation_manager.get_history(user_id, limit=6)
+
+                cached_answer = self.cache_manager.get(query, context, user_id, query_embedding=query_embedding)
+                if cached_answer:
+                    self.logger.info(f"Возвращен кэшированный ответ для пользователя {user_id}")
+                    answer = cached_answer
+                    is_cached = True
+                else:
+                    answer = await asyncio.to_thread(
+                        self.openai_service.generate_answer,
+                        query,
+                        context,
+                        conversation_history=conversation_history,
+                        max_context_tokens=60000,
+                        context_tokens=total_tokens
+                    )
+                    self.cache_manager.set(query, context, user_id, answer, query_embedding=query_embedding)
+                    is_cached = False
 
-            self.conversation_manager.add_user_message(user_id, query)
-            self.conversation_manager.add_assistant_message(user_id, answer)
+                self.conversation_manager.add_user_message(user_id, query)
+                self.conversation_manager.add_assistant_message(user_id, answer)
 
             docs_used = len(context_parts)
             response = f"📚 Ответ на основе твоих документов:\n\n{answer}\n\n"
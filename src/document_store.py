@@ -1,24 +1,43 @@
+import functools
 import json
+import math
 import os
-from typing import List, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple
 import numpy as np
 import faiss
 from src.openai_service import OpenAIService
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 class DocumentStore:
     def __init__(self, storage_dir: str = "documents"):
         self.storage_dir = storage_dir
         self.openai_service = OpenAIService()
         self.documents: List[Dict] = []
-        self.index: Optional[faiss.Index] = None
+        self.indices: Dict[int, faiss.Index] = {}
         self.embedding_dim = 1536
-        self._index_to_doc_map: List[int] = []
+        # Partitions of at least sq_min_vectors keep int8 (SQ8) codes in RAM; float32 stays in embeddings.f32.
+        # Partitions larger than ivf_threshold are searched through an IVF index probing ivf_nprobe clusters
+        self.sq_min_vectors = 256
+        self.ivf_threshold = 4096
+        self.ivf_nprobe = 16
+        self._id_to_doc: Dict[int, Dict] = {}
+        self._next_index_id = 0
+        self._text_cache = functools.lru_cache(maxsize=64)(self._read_text_file)
 
         os.makedirs(storage_dir, exist_ok=True)
         self.metadata_file = os.path.join(storage_dir, "metadata.json")
+        self.embeddings_file = os.path.join(storage_dir, "embeddings.f32")
+        self.index_dir = os.path.join(storage_dir, "faiss_indices")
+        os.makedirs(self.index_dir, exist_ok=True)
 
+        self.embeddings: Optional[np.memmap] = self._open_embeddings()
         self._load_documents()
-        self._build_index()
+        self._load_indices()
     
     def _load_documents(self):
         """Загружает метаданные документов из файла"""
@@ -29,118 +48,301 @@ class DocumentStore:
             except Exception as e:
                 print(f"Ошибка при загрузке документов: {e}")
                 self.documents = []
+
+        # Every document needs a stable int64 id for IndexIDMap2 (also its row in embeddings.f32);
+        # older metadata files don't have one
+        self._next_index_id = max(
+            max((doc.get('index_id', -1) for doc in self.documents), default=-1) + 1,
+            self._embedding_rows()
+        )
+        missing_ids = [doc for doc in self.documents if 'index_id' not in doc]
+        for doc in missing_ids:
+            doc['index_id'] = self._next_index_id
+            self._next_index_id += 1
+        if missing_ids:
+            self._save_documents()
     
     def _save_documents(self):
         """Сохраняет метаданные документов в файл"""
         try:
-            with open(self.metadata_file, 'w', encoding='utf-8') as f:
-                json.dump(self.documents, f, ensure_ascii=False, indent=2)
+            # Compact encoding, written to a temp file and swapped in so a crash never leaves a torn file
+            if orjson is not None:
+                data = orjson.dumps(self.documents)
+            else:
+                data = json.dumps(self.documents, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            tmp_file = f"{self.metadata_file}.tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_file, self.metadata_file)
         except Exception as e:
             print(f"Ошибка при сохранении документов: {e}")
     
-    def _build_index(self):
-        """Builds FAISS index for embedding-based search"""
-        if not self.documents:
-            self.index = None
-            return
+    def _create_index(self, vectors: Optional[np.ndarray] = None) -> faiss.Index:
+        """Creates an empty inner-product index for one user's partition, addressed by document index_id, trained on vectors: flat, SQ8 or IVF-SQ8 by partition size"""
+        count = 0 if vectors is None else len(vectors)
+        if count < self.sq_min_vectors:
+            return faiss.IndexIDMap2(faiss.IndexFlatIP(self.embedding_dim))
 
-        if self.index is None:
-            self.index = faiss.IndexFlatL2(self.embedding_dim)
+        if count <= self.ivf_threshold:
+            index = faiss.IndexScalarQuantizer(self.embedding_dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+            index.train(vectors)
+            return faiss.IndexIDMap2(index)
 
-        self.index.reset()
+        nlist = int(4 * math.sqrt(count))
+        quantizer = faiss.IndexFlatIP(self.embedding_dim)
+        ivf = faiss.IndexIVFScalarQuantizer(
+            quantizer, self.embedding_dim, nlist, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+        )
+        ivf.train(vectors)
+        ivf.nprobe = self.ivf_nprobe
+        return faiss.IndexIDMap2(ivf)
 
-        embeddings = []
-        valid_doc_indices = []
+    def _is_ivf(self, index: faiss.Index) -> bool:
+        """Returns True if a partition index is IVF-based"""
+        return isinstance(faiss.downcast_index(index.index), faiss.IndexIVF)
 
-        for i, doc in enumerate(self.documents):
-            if 'embedding' in doc and doc['embedding']:
-                embedding = doc['embedding']
-                if isinstance(embedding, list) and len(embedding) == self.embedding_dim:
-                    embeddings.append(embedding)
-                    valid_doc_indices.append(i)
+    def _index_level(self, count: int) -> int:
+        """Returns the index type a partition of count vectors should use: 0 flat, 1 SQ8, 2 IVF-SQ8"""
+        if count > self.ivf_threshold:
+            return 2
+        return 1 if count >= self.sq_min_vectors else 0
 
-        if embeddings:
-            embeddings_array = np.array(embeddings, dtype=np.float32)
-            self.index.add(embeddings_array)
-            self._index_to_doc_map = valid_doc_indices
+    def _needs_rebuild(self, index: faiss.Index) -> bool:
+        """Returns True if a partition has outgrown its index type"""
+        inner = faiss.downcast_index(index.index)
+        if isinstance(inner, faiss.IndexIVF):
+            current = 2
+        elif isinstance(inner, faiss.IndexScalarQuantizer):
+            current = 1
         else:
-            self.index = None
-            self._index_to_doc_map = []
+            current = 0
+        return self._index_level(index.ntotal) > current
+
+    def _get_index_file(self, user_id: int) -> str:
+        """Returns the path to the serialized FAISS index of a user"""
+        return os.path.join(self.index_dir, f"user_{user_id}.index")
+
+    def _save_index(self, user_id: int):
+        """Writes a user's FAISS index to disk (atomically, so a memory-mapped copy is never overwritten in place)"""
+        index_file = self._get_index_file(user_id)
+        try:
+            index = self.indices.get(user_id)
+            if index is None:
+                if os.path.exists(index_file):
+                    os.remove(index_file)
+                return
+            tmp_file = index_file + ".tmp"
+            faiss.write_index(index, tmp_file)
+            os.replace(tmp_file, index_file)
+        except Exception as e:
+            print(f"Ошибка при сохранении индекса для user_id {user_id}: {e}")
+
+    def _open_embeddings(self) -> Optional[np.memmap]:
+        """Memory-maps embeddings.f32 as an (N, embedding_dim) float32 array; row N holds the document with index_id N"""
+        if not os.path.exists(self.embeddings_file):
+            return None
+        rows = os.path.getsize(self.embeddings_file) // (self.embedding_dim * 4)
+        if rows == 0:
+            return None
+        return np.memmap(self.embeddings_file, dtype=np.float32, mode='r+', shape=(rows, self.embedding_dim))
+
+    def _embedding_rows(self) -> int:
+        """Returns the number of rows in embeddings.f32"""
+        return 0 if self.embeddings is None else self.embeddings.shape[0]
+
+    def _store_embeddings(self, index_ids: List[int], vectors: np.ndarray):
+        """Writes normalized vectors to embeddings.f32 at rows index_ids, appending to the file when needed"""
+        current_rows = self._embedding_rows()
+        needed_rows = max(index_ids) + 1
+
+        if needed_rows > current_rows:
+            new_rows = np.zeros((needed_rows - current_rows, self.embedding_dim), dtype=np.float32)
+            for index_id, vector in zip(index_ids, vectors):
+                if index_id >= current_rows:
+                    new_rows[index_id - current_rows] = vector
+            self.embeddings = None
+            with open(self.embeddings_file, 'ab') as f:
+                f.write(new_rows.tobytes())
+            self.embeddings = self._open_embeddings()
+
+        existing = [(index_id, vector) for index_id, vector in zip(index_ids, vectors) if index_id < current_rows]
+        if existing:
+            self.embeddings[[index_id for index_id, _ in existing]] = np.array([vector for _, vector in existing])
+            self.embeddings.flush()
+
+    def _load_indices(self):
+        """Memory-maps per-user FAISS indices from disk; rebuilds a partition from embeddings.f32 if its file is missing or stale"""
+        self.indices = {}
+        self._id_to_doc = {}
+
+        # Older metadata files kept embeddings inline: move them into embeddings.f32
+        legacy_docs = [
+            doc for doc in self.documents
+            if isinstance(doc.get('embedding'), list) and len(doc['embedding']) == self.embedding_dim
+        ]
+        if legacy_docs:
+            vectors = np.array([doc['embedding'] for doc in legacy_docs], dtype=np.float32)
+            faiss.normalize_L2(vectors)
+            self._store_embeddings([doc['index_id'] for doc in legacy_docs], vectors)
+        migrated = False
+        for doc in self.documents:
+            if doc.pop('embedding', None) is not None:
+                migrated = True
+        if migrated:
+            self._save_documents()
+
+        user_docs: Dict[int, List[Dict]] = {}
+        for doc in self.documents:
+            user_id = doc.get('user_id')
+            if user_id is not None:
+                user_docs.setdefault(user_id, []).append(doc)
+                self._id_to_doc[doc['index_id']] = doc
+
+        for user_id, docs in user_docs.items():
+            index_file = self._get_index_file(user_id)
+            expected_ids = {doc['index_id'] for doc in docs}
+            if os.path.exists(index_file) and not migrated:
+                try:
+                    index = faiss.read_index(index_file, faiss.IO_FLAG_MMAP)
+                    if self._is_ivf(index):
+                        # Memory-mapped inverted lists are read-only, IVF partitions are loaded into memory
+                        index = faiss.read_index(index_file)
+                        faiss.downcast_index(index.index).nprobe = self.ivf_nprobe
+                    if set(faiss.vector_to_array(index.id_map).tolist()) == expected_ids and not self._needs_rebuild(index):
+                        self.indices[user_id] = index
+                        continue
+                    print(f"Индекс пользователя {user_id} не совпадает с метаданными, перестраиваю")
+                except Exception as e:
+                    print(f"Ошибка при чтении индекса {index_file}: {e}")
+
+            self._build_index(user_id, docs)
+            self._save_index(user_id)
+
+    def _build_index(self, user_id: int, docs: List[Dict]):
+        """Builds a user's FAISS index from the memory-mapped embeddings"""
+        rows = self._embedding_rows()
+        index_ids = [doc['index_id'] for doc in docs if doc['index_id'] < rows]
+
+        if len(index_ids) < len(docs):
+            print(f"У {len(docs) - len(index_ids)} документов пользователя {user_id} нет эмбеддингов, они не будут найдены поиском")
+
+        if not index_ids:
+            self.indices.pop(user_id, None)
+            return
+
+        vectors = np.ascontiguousarray(self.embeddings[index_ids])
+        index = self._create_index(vectors)
+        index.add_with_ids(vectors, np.array(index_ids, dtype=np.int64))
+        self.indices[user_id] = index
     
     def add_document(self, document_id: str, title: str, full_text: str, user_id: int) -> bool:
         """Adds document: summarizes, creates embedding, saves full text"""
+        return self.add_documents([(document_id, title, full_text, user_id)])
+
+    def add_documents(self, documents: List[Tuple[str, str, str, int]]) -> bool:
+        """Adds several (document_id, title, full_text, user_id) documents with one embeddings request and one metadata write"""
+        if not documents:
+            return True
         try:
-            summary = self.openai_service.summarize_document(full_text)
-            embedding = self.openai_service.get_embedding(summary)
+            texts = [full_text for _, _, full_text, _ in documents]
+            with ThreadPoolExecutor(max_workers=min(len(texts), 8)) as executor:
+                summaries = list(executor.map(self.openai_service.summarize_document, texts))
+            embeddings = self.openai_service.get_embeddings_batch(summaries)
 
-            if not embedding:
+            if len(embeddings) != len(documents):
                 return False
 
-            text_file = os.path.join(self.storage_dir, f"{document_id}.txt")
-            with open(text_file, 'w', encoding='utf-8') as f:
-                f.write(full_text)
-
-            doc = {
-                "id": document_id,
-                "title": title,
-                "summary": summary,
-                "embedding": embedding,
-                "text_file": text_file,
-                "user_id": user_id,
-                "created_at": str(os.path.getctime(text_file) if os.path.exists(text_file) else "")
-            }
-            
-            self.documents.append(doc)
+            embeddings_array = np.array(embeddings, dtype=np.float32)
+            faiss.normalize_L2(embeddings_array)
+
+            new_docs = []
+            for (document_id, title, full_text, user_id), summary in zip(documents, summaries):
+                text_file = os.path.join(self.storage_dir, f"{document_id}.txt")
+                with open(text_file, 'w', encoding='utf-8') as f:
+                    f.write(full_text)
+                    created_at = os.fstat(f.fileno()).st_ctime
+
+                new_docs.append({
+                    "id": document_id,
+                    "index_id": self._next_index_id,
+                    "title": title,
+                    "summary": summary,
+                    "text_file": text_file,
+                    "user_id": user_id,
+                    "created_at": created_at
+                })
+                self._next_index_id += 1
+
+            index_ids = [doc['index_id'] for doc in new_docs]
+            self._store_embeddings(index_ids, embeddings_array)
+            self.documents.extend(new_docs)
             self._save_documents()
-            self._build_index()
+
+            user_rows: Dict[int, List[int]] = {}
+            for row, doc in enumerate(new_docs):
+                user_rows.setdefault(doc['user_id'], []).append(row)
+                self._id_to_doc[doc['index_id']] = doc
+
+            for user_id, rows in user_rows.items():
+                if user_id not in self.indices:
+                    self.indices[user_id] = self._create_index()
+                self.indices[user_id].add_with_ids(
+                    embeddings_array[rows],
+                    np.array([index_ids[row] for row in rows], dtype=np.int64)
+                )
+                if self._needs_rebuild(self.indices[user_id]):
+                    self._build_index(user_id, [doc for doc in self.documents if doc.get('user_id') == user_id])
+                self._save_index(user_id)
             
             return True
         except Exception as e:
-            print(f"Ошибка при добавлении документа: {e}")
+            print(f"Ошибка при добавлении документов: {e}")
             return False
     
-    def search_documents(self, query: str, user_id: int, top_k: int = 3) -> List[Dict]:
-        """Searches for relevant documents by query"""
-        if not self.documents or self.index is None or not self._index_to_doc_map:
+    def search_documents(self, query: str, user_id: int, top_k: int = 3,
+                         similarity_threshold: float = 0.0,
+                         query_embedding: Optional[List[float]] = None) -> List[Dict]:
+        """Searches for relevant documents by cosine similarity (query_embedding skips re-embedding the query)"""
+        index = self.indices.get(user_id)
+        if index is None or index.ntotal == 0:
             return []
 
         try:
-            query_embedding = self.openai_service.get_embedding(query)
+            if not query_embedding:
+                query_embedding = self.openai_service.get_embedding(query)
             if not query_embedding:
                 return []
 
-            search_k = min(top_k * 5, len(self._index_to_doc_map))
             query_vector = np.array([query_embedding], dtype=np.float32)
-            distances, indices = self.index.search(query_vector, search_k)
+            faiss.normalize_L2(query_vector)
+            # Quantized indices only shortlist top_k * 4 candidates, so neighbours pushed down by SQ8 codes or by the coarser
+            # IVF-SQ8 probe still reach the rescore; order, threshold and similarities come from the float32 embeddings
+            _, indices = index.search(query_vector, min(top_k * 4, index.ntotal))
+            candidate_ids = [int(idx) for idx in indices[0] if 0 <= idx < self._embedding_rows()]
+            exact_scores = self.embeddings[candidate_ids] @ query_vector[0] if candidate_ids else []
+            ranked = sorted(zip(candidate_ids, exact_scores), key=lambda item: item[1], reverse=True)[:top_k]
 
             results = []
-            for idx, distance in zip(indices[0], distances[0]):
-                if idx < len(self._index_to_doc_map):
-                    doc_idx = self._index_to_doc_map[idx]
-                    if doc_idx < len(self.documents):
-                        doc = self.documents[doc_idx]
-                        if doc.get('user_id') == user_id:
-                            full_text = ""
-                            text_file = doc.get('text_file', '')
-                            if text_file and os.path.exists(text_file):
-                                try:
-                                    with open(text_file, 'r', encoding='utf-8') as f:
-                                        full_text = f.read()
-                                except Exception as e:
-                                    print(f"Ошибка при чтении файла {text_file}: {e}")
-                                    full_text = doc.get('summary', '')
-                            else:
-                                full_text = doc.get('summary', '')
-
-                            results.append({
-                                "title": doc.get('title', 'Без названия'),
-                                "summary": doc.get('summary', ''),
-                                "full_text": full_text,
-                                "distance": float(distance)
-                            })
-
-                            if len(results) >= top_k:
-                                break
+            for idx, score in ranked:
+                if score < similarity_threshold:
+                    break
+
+                doc = self._id_to_doc[idx]
+                try:
+                    full_text = self._text_cache(doc['id'])
+                except Exception as e:
+                    print(f"Ошибка при чтении текста документа {doc['id']}: {e}")
+                    full_text = None
+                if full_text is None:
+                    full_text = doc.get('summary', '')
+
+                results.append({
+                    "title": doc.get('title', 'Без названия'),
+                    "summary": doc.get('summary', ''),
+                    "full_text": full_text,
+                    "similarity": float(score),
+                    "distance": 1.0 - float(score)
+                })
             
             return results
         except Exception as e:
@@ -149,6 +351,14 @@ class DocumentStore:
             traceback.print_exc()
             return []
     
+    def _read_text_file(self, document_id: str) -> Optional[str]:
+        """Reads a document's full text from disk; called through the LRU cache in self._text_cache"""
+        text_file = os.path.join(self.storage_dir, f"{document_id}.txt")
+        if not os.path.exists(text_file):
+            return None
+        with open(text_file, 'r', encoding='utf-8') as f:
+            return f.read()
+
     def get_user_documents(self, user_id: int) -> List[Dict]:
         """Возвращает список всех документов пользователя"""
         return [doc for doc in self.documents if doc.get('user_id') == user_id]
@@ -165,10 +375,19 @@ class DocumentStore:
             if doc_to_delete:
                 if os.path.exists(doc_to_delete['text_file']):
                     os.remove(doc_to_delete['text_file'])
+                self._text_cache.cache_clear()
 
                 self.documents.remove(doc_to_delete)
                 self._save_documents()
-                self._build_index()
+
+                index_id = doc_to_delete['index_id']
+                index = self.indices.get(user_id)
+                if index is not None:
+                    index.remove_ids(np.array([index_id], dtype=np.int64))
+                    if index.ntotal == 0:
+                        del self.indices[user_id]
+                    self._save_index(user_id)
+                self._id_to_doc.pop(index_id, None)
                 return True
             
             return False
@@ -1,10 +1,24 @@
+import contextlib
 import json
 import os
-from typing import List, Dict, Optional
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Optional, Tuple
 import numpy as np
 from src.openai_service import OpenAIService
 from utils.logger_config import setup_logger
 
+try:
+    import simsimd
+except ImportError:
+    simsimd = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 class DocumentStore:
     """Simplified version of document storage without FAISS - uses only NumPy"""
 
@@ -15,18 +29,45 @@ class DocumentStore:
         self.documents: List[Dict] = []
         self.embedding_dim = 1536
         self.user_index: Dict[int, List[int]] = {}
+        # Slots of deleted documents: delete_document leaves a {'id', 'deleted', 'embedding_row'} tombstone in documents,
+        # add_document reuses the slot and its embedding row, and _compact drops tombstones once they exceed a quarter of the store
+        self.free_rows: List[int] = []
+        # L2-normalized document embeddings, memory-mapped from embedding_rows.f32 (raw float32 rows, appended in place);
+        # a document points at its row via embedding_row. Search runs on an int8 copy in RAM
+        # (row ≈ embeddings_i8 * embedding_scales), float32 stays on disk
+        self.embeddings_matrix = np.empty((0, self.embedding_dim), dtype=np.float32)
+        self.embeddings_i8 = np.empty((0, self.embedding_dim), dtype=np.int8)
+        self.embedding_scales = np.empty(0, dtype=np.float32)
+        # add_document runs in worker threads, so documents/user_index changes are serialized
+        self._lock = threading.RLock()
+        # Inside bulk() metadata.json is only marked dirty and written once when the block exits
+        self._bulk_depth = 0
+        self._documents_dirty = False
+        # Documents at least this long get a per-document chunk index for answering
+        self.chunk_min_length = 5000
+        self.chunk_size = 1500
+        # Full texts of recently returned documents, so repeated searches don't re-read and re-decode the files
+        self.text_cache_size = 64
+        self._text_cache: "OrderedDict[str, str]" = OrderedDict()
 
         os.makedirs(storage_dir, exist_ok=True)
         self.metadata_file = os.path.join(storage_dir, "metadata.json")
+        self.embeddings_file = os.path.join(storage_dir, "embedding_rows.f32")
+        self.legacy_embeddings_file = os.path.join(storage_dir, "embeddings.npy")
 
         self._load_documents()
+        self._load_embeddings()
         self._build_user_index()
         self.logger.info(f"DocumentStore инициализирован. Загружено документов: {len(self.documents)}")
     
     def _build_user_index(self):
-        """Builds index user_id -> document indices for fast lookup"""
+        """Builds index user_id -> document indices for fast lookup, and collects the slots of deleted documents"""
         self.user_index = {}
+        self.free_rows = []
         for idx, doc in enumerate(self.documents):
+            if doc.get('deleted'):
+                self.free_rows.append(idx)
+                continue
             user_id = doc.get('user_id')
             if user_id is not None:
                 if user_id not in self.user_index:
@@ -46,62 +87,327 @@ class DocumentStore:
                 self.documents = []
     
     def _save_documents(self):
-        """Saves document metadata to file"""
+        """Saves document metadata to file (deferred to the end of a bulk() block)"""
+        self._documents_dirty = True
+        if self._bulk_depth:
+            return
         try:
-            with open(self.metadata_file, 'w', encoding='utf-8') as f:
-                json.dump(self.documents, f, ensure_ascii=False, indent=2)
+            # Compact encoding, written to a temp file and swapped in so a crash never leaves a torn file
+            if orjson is not None:
+                data = orjson.dumps(self.documents)
+            else:
+                data = json.dumps(self.documents, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            tmp_file = f"{self.metadata_file}.tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_file, self.metadata_file)
+            self._documents_dirty = False
             self.logger.info(f"Метаданные документов сохранены в {self.metadata_file}")
         except Exception as e:
             self.logger.error(f"Ошибка при сохранении документов: {e}", exc_info=True)
+
+    @contextlib.contextmanager
+    def bulk(self):
+        """Groups several add/delete calls so that metadata is written once, when the block exits (embedding rows are
+        appended as they come). The deferral is store-wide: saves from other threads during the block are flushed at its end too"""
+        with self._lock:
+            self._bulk_depth += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._bulk_depth -= 1
+                if not self._bulk_depth:
+                    if self._documents_dirty:
+                        self._save_documents()
+                    if len(self.free_rows) > len(self.documents) // 4:
+                        self._compact()
     
-    def _cosine_similarity(self, vec1: List[float], vec2: List[float]) -> float:
-        """Calculates cosine similarity between two vectors"""
+    def _normalize_rows(self, matrix: np.ndarray) -> np.ndarray:
+        """L2-normalizes matrix rows in place"""
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True).clip(min=1e-12)
+        return matrix
+
+    def _top_k_indices(self, scores: np.ndarray, k: int) -> np.ndarray:
+        """Returns the indices of the k highest scores in ascending index order, selected in O(n) with argpartition"""
+        if k >= len(scores):
+            return np.arange(len(scores))
+        return np.sort(np.argpartition(-scores, k - 1)[:k])
+
+    def _quantize_rows(self, matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Quantizes rows to int8 with a per-row scale, so that row ≈ quantized * scale"""
+        scales = (np.abs(matrix).max(axis=1) / 127.0).clip(min=1e-12).astype(np.float32)
+        quantized = np.round(matrix / scales[:, None]).astype(np.int8)
+        return quantized, scales
+
+    def _similarities(self, rows_i8: np.ndarray, scales: np.ndarray, query_units: np.ndarray) -> np.ndarray:
+        """Cosine similarities (queries × rows) of int8 rows to L2-normalized queries: rows are normalized too, so a scaled
+        dot product suffices. Uses SimSIMD's int8 dot kernel when installed, otherwise one NumPy matrix product"""
+        if simsimd is not None and len(rows_i8):
+            queries_i8, query_scales = self._quantize_rows(query_units)
+            dots = np.asarray(simsimd.cdist(queries_i8, rows_i8, metric='dot')).reshape(len(query_units), -1)
+            return dots * scales * query_scales[:, None]
+        return (query_units @ rows_i8.T) * scales
+
+    def _load_embeddings(self):
+        """Memory-maps embedding_rows.f32; embeddings from embeddings.npy or still inline in metadata.json are moved into it"""
+        if not os.path.exists(self.embeddings_file) and os.path.exists(self.legacy_embeddings_file):
+            self._migrate_npy_embeddings()
         try:
-            v1 = np.array(vec1, dtype=np.float32)
-            v2 = np.array(vec2, dtype=np.float32)
-            dot_product = np.dot(v1, v2)
-            norm1 = np.linalg.norm(v1)
-            norm2 = np.linalg.norm(v2)
-            if norm1 == 0 or norm2 == 0:
-                return 0.0
-            return float(dot_product / (norm1 * norm2))
+            if os.path.exists(self.embeddings_file):
+                # A crash in the middle of an append leaves a partial row at the end: cut it so later rows stay aligned
+                row_bytes = self.embedding_dim * 4
+                size = os.path.getsize(self.embeddings_file)
+                if size % row_bytes:
+                    with open(self.embeddings_file, 'r+b') as f:
+                        f.truncate(size - size % row_bytes)
+            self.embeddings_matrix = self._open_embeddings()
         except Exception as e:
-            print(f"Ошибка при вычислении косинусного сходства: {e}")
-            return 0.0
-    
+            self.logger.error(f"Ошибка при загрузке эмбеддингов из {self.embeddings_file}: {e}", exc_info=True)
+
+        legacy_docs = [doc for doc in self.documents if 'embedding' in doc]
+        if legacy_docs:
+            self._migrate_inline_embeddings(legacy_docs)
+
+        self.embeddings_i8, self.embedding_scales = self._quantize_rows(np.asarray(self.embeddings_matrix))
+
+    def _migrate_npy_embeddings(self):
+        """Converts embeddings.npy of earlier versions into embedding_rows.f32, keeping the row numbers"""
+        try:
+            matrix = np.load(self.legacy_embeddings_file)
+            tmp_file = f"{self.embeddings_file}.tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(np.ascontiguousarray(matrix, dtype=np.float32).tobytes())
+            os.replace(tmp_file, self.embeddings_file)
+            os.remove(self.legacy_embeddings_file)
+            self.logger.info(f"Эмбеддинги перенесены из {self.legacy_embeddings_file} в {self.embeddings_file}")
+        except Exception as e:
+            self.logger.error(f"Ошибка при переносе эмбеддингов из {self.legacy_embeddings_file}: {e}", exc_info=True)
+
+    def _migrate_inline_embeddings(self, legacy_docs: List[Dict]):
+        """Moves embeddings stored inline in metadata.json into embedding_rows.f32"""
+        with_embedding = [doc for doc in legacy_docs if doc['embedding']]
+        if with_embedding:
+            rows = self._normalize_rows(np.asarray([doc['embedding'] for doc in with_embedding], dtype=np.float32))
+            start = len(self.embeddings_matrix)
+            self._append_embeddings(rows)
+            for offset, doc in enumerate(with_embedding):
+                doc['embedding_row'] = start + offset
+        for doc in legacy_docs:
+            del doc['embedding']
+        self._save_documents()
+        self.logger.info(f"Эмбеддинги {len(with_embedding)} документов перенесены в {self.embeddings_file}")
+
+    def _open_embeddings(self) -> np.ndarray:
+        """Memory-maps embedding_rows.f32 read-only as an (N, embedding_dim) float32 array"""
+        rows = os.path.getsize(self.embeddings_file) // (self.embedding_dim * 4) if os.path.exists(self.embeddings_file) else 0
+        if rows == 0:
+            return np.empty((0, self.embedding_dim), dtype=np.float32)
+        return np.memmap(self.embeddings_file, dtype=np.float32, mode='r', shape=(rows, self.embedding_dim))
+
+    def _append_embeddings(self, rows: np.ndarray):
+        """Appends rows to the end of embedding_rows.f32 and re-maps it; existing rows are neither read nor rewritten"""
+        with open(self.embeddings_file, 'ab') as f:
+            try:
+                f.write(np.ascontiguousarray(rows, dtype=np.float32).tobytes())
+                f.flush()
+            except Exception:
+                # Cut a partially written row so the file stays in step with the mapped rows
+                f.truncate(len(self.embeddings_matrix) * self.embedding_dim * 4)
+                raise
+        self.embeddings_matrix = self._open_embeddings()
+
+    def _write_embedding_row(self, row_index: int, row: np.ndarray):
+        """Overwrites one row of embedding_rows.f32 in place through a writable memory map of just that row"""
+        target = np.memmap(self.embeddings_file, dtype=np.float32, mode='r+', offset=row_index * self.embedding_dim * 4,
+                           shape=(1, self.embedding_dim))
+        target[0] = row
+        target.flush()
+        del target
+
+    def _compact(self):
+        """Drops tombstoned documents and embedding rows no document points at, renumbering both. The only place
+        embedding_rows.f32 is rewritten; in-memory state changes only after the new file is in place"""
+        try:
+            row_count = len(self.embeddings_matrix)
+            alive = [doc for doc in self.documents if not doc.get('deleted')]
+            with_row = [doc for doc in alive if doc.get('embedding_row', row_count) < row_count]
+            rows = np.asarray([doc['embedding_row'] for doc in with_row], dtype=np.int64)
+
+            tmp_file = f"{self.embeddings_file}.tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(np.ascontiguousarray(self.embeddings_matrix[rows], dtype=np.float32).tobytes())
+            # Windows refuses to replace a file that is still mapped, so the store drops its own mapping first
+            # (searches take their snapshot under the lock held here); if the replace fails the old file is re-mapped
+            self.embeddings_matrix = np.empty((0, self.embedding_dim), dtype=np.float32)
+            try:
+                os.replace(tmp_file, self.embeddings_file)
+            finally:
+                self.embeddings_matrix = self._open_embeddings()
+
+            self.embeddings_i8 = self.embeddings_i8[rows]
+            self.embedding_scales = self.embedding_scales[rows]
+            for new_row, doc in enumerate(with_row):
+                doc['embedding_row'] = new_row
+            removed = len(self.documents) - len(alive)
+            self.documents = alive
+            self._save_documents()
+            self._build_user_index()
+            self.logger.info(f"Хранилище уплотнено: удалено {removed} записей удаленных документов")
+        except Exception as e:
+            self.logger.error(f"Ошибка при уплотнении хранилища: {e}", exc_info=True)
+
+    def _read_text(self, text_file: str) -> str:
+        """Returns the full text of a document file, served from an in-memory LRU after the first read"""
+        with self._lock:
+            text = self._text_cache.get(text_file)
+            if text is not None:
+                self._text_cache.move_to_end(text_file)
+                return text
+
+        with open(text_file, 'r', encoding='utf-8') as f:
+            text = f.read()
+
+        with self._lock:
+            self._text_cache[text_file] = text
+            if len(self._text_cache) > self.text_cache_size:
+                self._text_cache.popitem(last=False)
+        return text
+
+    def _get_chunk_file(self, document_id: str) -> str:
+        """Returns path of the chunk index file of a document"""
+        return os.path.join(self.storage_dir, f"{document_id}.chunks.npz")
+
+    def _split_into_chunks(self, text: str) -> List[str]:
+        """Splits text into chunks of up to chunk_size characters along paragraph boundaries"""
+        chunks = []
+        current = ""
+        for para in text.split('\n\n'):
+            para = para.strip()
+            if not para:
+                continue
+            while len(para) > self.chunk_size:
+                if current:
+                    chunks.append(current)
+                    current = ""
+                chunks.append(para[:self.chunk_size])
+                para = para[self.chunk_size:]
+            if current and len(current) + len(para) + 2 > self.chunk_size:
+                chunks.append(current)
+                current = ""
+            current = f"{current}\n\n{para}" if current else para
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def _build_chunk_index(self, document_id: str, chunks: List[str], embeddings: List[List[float]]) -> Optional[str]:
+        """Saves document chunks and their embeddings as {document_id}.chunks.npz"""
+        if not chunks:
+            return None
+
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        token_counts = np.array([self.openai_service.estimate_tokens(chunk) for chunk in chunks], dtype=np.int32)
+        chunk_file = self._get_chunk_file(document_id)
+        np.savez(chunk_file, chunks=np.array(chunks), embeddings=matrix / norms, token_counts=token_counts)
+        self.logger.info(f"Индекс частей документа {document_id} сохранен ({len(chunks)} частей)")
+        return chunk_file
+
+    def _load_chunk_index(self, doc: Dict) -> Optional[Dict]:
+        """Loads the chunk index of a document, if it has one"""
+        chunk_file = doc.get('chunk_file')
+        if not chunk_file or not os.path.exists(chunk_file):
+            return None
+        try:
+            with np.load(chunk_file) as data:
+                token_counts = data['token_counts'].tolist() if 'token_counts' in data.files else None
+                return {"chunks": data['chunks'].tolist(), "embeddings": data['embeddings'], "token_counts": token_counts}
+        except Exception as e:
+            self.logger.error(f"Ошибка при чтении индекса частей {chunk_file}: {e}")
+            return None
+
+    def search_chunks(self, chunk_index: Dict, query_embedding: List[float], top_k: int = 2) -> List[Tuple[str, int]]:
+        """Returns (chunk, token count) for the top_k chunks of a document most similar to the query, in document order"""
+        query_vec = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query_vec)
+        if norm == 0:
+            return []
+        scores = chunk_index['embeddings'] @ (query_vec / norm)
+        top = self._top_k_indices(scores, top_k)
+        chunks = chunk_index['chunks']
+        token_counts = chunk_index.get('token_counts')
+        return [
+            (chunks[i], token_counts[i] if token_counts else self.openai_service.estimate_tokens(chunks[i]))
+            for i in top
+        ]
+
     def add_document(self, document_id: str, title: str, full_text: str, user_id: int) -> bool:
         """Adds document: summarizes, creates embedding, saves full text"""
         try:
             self.logger.info(f"Добавление документа '{title}' (user_id: {user_id}, длина: {len(full_text)} символов)")
 
             summary = self.openai_service.summarize_document(full_text)
-            embedding = self.openai_service.get_embedding(summary)
 
-            if not embedding:
+            # The summary and all chunks of a long document are embedded with one batched request
+            chunks = self._split_into_chunks(full_text) if len(full_text) >= self.chunk_min_length else []
+            embeddings = self.openai_service.get_embeddings_batch([summary] + chunks)
+
+            if len(embeddings) != len(chunks) + 1:
                 self.logger.error("Не удалось получить эмбеддинг для документа")
                 return False
+            embedding = embeddings[0]
 
             text_file = os.path.join(self.storage_dir, f"{document_id}.txt")
             with open(text_file, 'w', encoding='utf-8') as f:
                 f.write(full_text)
+            with self._lock:
+                self._text_cache.pop(text_file, None)
+
+            chunk_file = self._build_chunk_index(document_id, chunks, embeddings[1:])
 
             doc = {
                 "id": document_id,
                 "title": title,
                 "summary": summary,
-                "embedding": embedding,
                 "text_file": text_file,
+                "chunk_file": chunk_file,
+                "summary_tokens": self.openai_service.estimate_tokens(summary),
+                "text_tokens": self.openai_service.estimate_tokens(full_text),
                 "user_id": user_id,
-                "created_at": str(os.path.getctime(text_file) if os.path.exists(text_file) else "")
+                "created_at": int(time.time())
             }
 
-            self.documents.append(doc)
-            self._save_documents()
+            row = self._normalize_rows(np.asarray([embedding], dtype=np.float32))
 
-            doc_index = len(self.documents) - 1
-            if user_id not in self.user_index:
-                self.user_index[user_id] = []
-            self.user_index[user_id].append(doc_index)
+            row_i8, row_scale = self._quantize_rows(row)
+
+            with self._lock:
+                doc_index = self.free_rows[-1] if self.free_rows else len(self.documents)
+                free_row = self.documents[doc_index].get('embedding_row') if doc_index < len(self.documents) else None
+                # The row goes to disk first, so a failed write leaves documents, rows and free slots as they were
+                if free_row is not None and free_row < len(self.embeddings_matrix):
+                    # Searches snapshot only live documents, so nothing in flight reads the tombstone's row
+                    self._write_embedding_row(free_row, row[0])
+                    self.embeddings_i8[free_row] = row_i8[0]
+                    self.embedding_scales[free_row] = row_scale[0]
+                    doc['embedding_row'] = free_row
+                else:
+                    doc['embedding_row'] = len(self.embeddings_matrix)
+                    self._append_embeddings(row)
+                    self.embeddings_i8 = np.vstack([self.embeddings_i8, row_i8])
+                    self.embedding_scales = np.append(self.embedding_scales, row_scale)
+
+                if doc_index < len(self.documents):
+                    self.free_rows.pop()
+                    self.documents[doc_index] = doc
+                else:
+                    self.documents.append(doc)
+                self._save_documents()
+
+                if user_id not in self.user_index:
+                    self.user_index[user_id] = []
+                self.user_index[user_id].append(doc_index)
 
             self.logger.info(f"Документ '{title}' успешно добавлен (ID: {document_id})")
             return True
@@ -109,9 +415,90 @@ class DocumentStore:
             self.logger.error(f"Ошибка при добавлении документа: {e}", exc_info=True)
             return False
     
+    def _user_partition(self, user_id: int) -> Tuple[List[Dict], np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Snapshots a user's searchable documents with their embedding rows, int8 codes, scales and the float32 matrix"""
+        with self._lock:
+            row_count = len(self.embeddings_i8)
+            user_docs = [
+                doc for doc in (self.documents[idx] for idx in self.user_index.get(user_id, []))
+                if doc.get('embedding_row', row_count) < row_count
+            ]
+            rows = np.asarray([doc['embedding_row'] for doc in user_docs], dtype=np.int64)
+            return user_docs, rows, self.embeddings_i8[rows], self.embedding_scales[rows], self.embeddings_matrix
+
+    def _unit_vector(self, embedding: List[float]) -> Optional[np.ndarray]:
+        """Returns the L2-normalized embedding, or None for a zero vector"""
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return None
+        return vector / norm
+
+    def _rank(self, user_docs: List[Dict], rows: np.ndarray, approximate: np.ndarray, query_unit: np.ndarray,
+              embeddings_matrix: np.ndarray, top_k: int, similarity_threshold: float,
+              full_text_threshold: float = 0.0) -> List[Dict]:
+        """Rescores the int8 shortlist exactly and builds the top_k results"""
+        # int8 scores shortlist candidates; the exact float32 rows from disk decide order, threshold and reported similarity
+        shortlist = self._top_k_indices(approximate, top_k * 4)
+        similarities = np.zeros(len(user_docs), dtype=np.float32)
+        similarities[shortlist] = np.asarray(embeddings_matrix[rows[shortlist]]) @ query_unit
+        candidates = shortlist[similarities[shortlist] >= similarity_threshold]
+
+        self.logger.info(
+            f"Найдено {len(candidates)} документов пользователя "
+            f"(после фильтрации по threshold={similarity_threshold})"
+        )
+
+        top = candidates[np.argsort(-similarities[candidates], kind='stable')[:top_k]]
+
+        results = []
+        for position in top:
+            similarity = float(similarities[position])
+            doc = user_docs[position]
+            if similarity < full_text_threshold:
+                # Weak match: the summary stands in for the text, so neither the text file nor the chunk index is read
+                results.append({
+                    "title": doc.get('title', 'Без названия'),
+                    "summary": doc.get('summary', ''),
+                    "full_text": doc.get('summary', ''),
+                    "chunk_index": None,
+                    "summary_tokens": doc.get('summary_tokens'),
+                    "text_tokens": doc.get('summary_tokens'),
+                    "similarity": similarity,
+                    "distance": 1.0 - similarity
+                })
+                continue
+
+            full_text = doc.get('summary', '')
+            text_file = doc.get('text_file', '')
+            if text_file:
+                try:
+                    full_text = self._read_text(text_file)
+                except FileNotFoundError:
+                    pass
+                except Exception as e:
+                    self.logger.error(f"Ошибка при чтении файла {text_file}: {e}")
+
+            results.append({
+                "title": doc.get('title', 'Без названия'),
+                "summary": doc.get('summary', ''),
+                "full_text": full_text,
+                "chunk_index": self._load_chunk_index(doc),
+                "summary_tokens": doc.get('summary_tokens'),
+                "text_tokens": doc.get('text_tokens'),
+                "similarity": similarity,
+                "distance": 1.0 - similarity
+            })
+        return results
+
     def search_documents(self, query: str, user_id: int, top_k: int = 3,
-                         similarity_threshold: float = 0.0) -> List[Dict]:
-        """Searches for relevant documents by query using cosine similarity"""
+                         similarity_threshold: float = 0.0,
+                         query_embedding: Optional[List[float]] = None,
+                         full_text_threshold: float = 0.0) -> List[Dict]:
+        """Searches for relevant documents by query using cosine similarity (query_embedding skips re-embedding the query).
+        Matches below full_text_threshold return the summary as full_text: no file read and a much shorter prompt, but the
+        answer can only use what the summary kept. Disabled (0.0) by default; embedding similarities of relevant documents
+        are often well below 0.8, so calibrate the threshold on real queries before raising it"""
         if not self.documents:
             self.logger.warning("Нет документов для поиска")
             return []
@@ -122,101 +509,116 @@ class DocumentStore:
                 f"(user_id: {user_id}, top_k: {top_k}, threshold: {similarity_threshold})"
             )
 
-            if user_id not in self.user_index or not self.user_index[user_id]:
+            user_docs, rows, user_i8, user_scales, embeddings_matrix = self._user_partition(user_id)
+            if not user_docs:
                 self.logger.warning(f"У пользователя {user_id} нет документов")
                 return []
 
-            query_embedding = self.openai_service.get_embedding(query)
+            if not query_embedding:
+                query_embedding = self.openai_service.get_embedding(query)
             if not query_embedding:
                 self.logger.error("Не удалось получить эмбеддинг для запроса")
                 return []
 
-            similarities = []
-            for doc_idx in self.user_index[user_id]:
-                doc = self.documents[doc_idx]
+            query_unit = self._unit_vector(query_embedding)
+            if query_unit is None:
+                return []
 
-                if 'embedding' not in doc or not doc['embedding']:
-                    continue
+            approximate = self._similarities(user_i8, user_scales, query_unit.reshape(1, -1))[0]
+            results = self._rank(
+                user_docs, rows, approximate, query_unit, embeddings_matrix, top_k, similarity_threshold, full_text_threshold
+            )
 
-                similarity = self._cosine_similarity(query_embedding, doc['embedding'])
+            self.logger.info(f"Возвращено {len(results)} релевантных документов")
+            return results
+        except Exception as e:
+            self.logger.error(f"Ошибка при поиске документов: {e}", exc_info=True)
+            return []
 
-                if similarity >= similarity_threshold:
-                    similarities.append((similarity, doc))
+    def search_many(self, queries: List[Tuple[str, int]], top_k: int = 3,
+                    similarity_threshold: float = 0.0, full_text_threshold: float = 0.0) -> List[List[Dict]]:
+        """Searches several (query, user_id) pairs at once: queries are embedded in one batch and each user's documents are
+        scored against all of that user's queries with one matrix product. Returns one result list per query, in order"""
+        results: List[List[Dict]] = [[] for _ in queries]
+        if not queries or not self.documents:
+            return results
 
-            self.logger.info(
-                f"Найдено {len(similarities)} документов пользователя "
-                f"(после фильтрации по threshold={similarity_threshold})"
-            )
+        try:
+            embeddings = self.openai_service.get_embeddings_batch([query for query, _ in queries])
+            if len(embeddings) != len(queries):
+                self.logger.error("Не удалось получить эмбеддинги для запросов")
+                return results
 
-            similarities.sort(key=lambda x: x[0], reverse=True)
-
-            results = []
-            for similarity, doc in similarities[:top_k]:
-                full_text = ""
-                text_file = doc.get('text_file', '')
-                if text_file and os.path.exists(text_file):
-                    try:
-                        with open(text_file, 'r', encoding='utf-8') as f:
-                            full_text = f.read()
-                    except Exception as e:
-                        self.logger.error(f"Ошибка при чтении файла {text_file}: {e}")
-                        full_text = doc.get('summary', '')
-                else:
-                    full_text = doc.get('summary', '')
+            positions_by_user: Dict[int, List[int]] = {}
+            for position, (_, user_id) in enumerate(queries):
+                positions_by_user.setdefault(user_id, []).append(position)
 
-                results.append({
-                    "title": doc.get('title', 'Без названия'),
-                    "summary": doc.get('summary', ''),
-                    "full_text": full_text,
-                    "similarity": similarity,
-                    "distance": 1.0 - similarity
-                })
+            for user_id, positions in positions_by_user.items():
+                user_docs, rows, user_i8, user_scales, embeddings_matrix = self._user_partition(user_id)
+                query_units = [(position, self._unit_vector(embeddings[position])) for position in positions]
+                query_units = [(position, unit) for position, unit in query_units if unit is not None]
+                if not user_docs or not query_units:
+                    continue
 
-            self.logger.info(f"Возвращено {len(results)} релевантных документов")
+                approximate = self._similarities(user_i8, user_scales, np.stack([unit for _, unit in query_units]))
+                for (position, query_unit), scores in zip(query_units, approximate):
+                    results[position] = self._rank(
+                        user_docs, rows, scores, query_unit, embeddings_matrix, top_k, similarity_threshold,
+                        full_text_threshold
+                    )
+
+            self.logger.info(f"Пакетный поиск: {len(queries)} запросов от {len(positions_by_user)} пользователей")
             return results
         except Exception as e:
-            self.logger.error(f"Ошибка при поиске документов: {e}", exc_info=True)
-            return []
+            self.logger.error(f"Ошибка при пакетном поиске документов: {e}", exc_info=True)
+            return results
     
     def get_user_documents(self, user_id: int) -> List[Dict]:
         """Returns list of all user documents"""
-        if user_id not in self.user_index:
-            return []
-        return [self.documents[idx] for idx in self.user_index[user_id]]
+        with self._lock:
+            if user_id not in self.user_index:
+                return []
+            return [self.documents[idx] for idx in self.user_index[user_id]]
     
     def delete_document(self, document_id: str, user_id: int) -> bool:
         """Deletes document"""
         try:
             self.logger.info(f"Удаление документа (ID: {document_id}, user_id: {user_id})")
 
-            doc_to_delete = None
-            for doc in self.documents:
-                if doc['id'] == document_id and doc.get('user_id') == user_id:
-                    doc_to_delete = doc
-                    break
+            with self._lock:
+                doc_idx = next(
+                    (idx for idx in self.user_index.get(user_id, []) if self.documents[idx]['id'] == document_id),
+                    None
+                )
+                if doc_idx is None:
+                    self.logger.warning(f"Документ с ID {document_id} не найден для user_id {user_id}")
+                    return False
 
-            if doc_to_delete:
+                doc_to_delete = self.documents[doc_idx]
+                self._text_cache.pop(doc_to_delete['text_file'], None)
                 if os.path.exists(doc_to_delete['text_file']):
                     os.remove(doc_to_delete['text_file'])
                     self.logger.info(f"Файл документа {doc_to_delete['text_file']} удален")
+                chunk_file = doc_to_delete.get('chunk_file')
+                if chunk_file and os.path.exists(chunk_file):
+                    os.remove(chunk_file)
 
-                doc_idx = self.documents.index(doc_to_delete)
-                self.documents.remove(doc_to_delete)
-
-                if user_id in self.user_index:
-                    self.user_index[user_id] = [
-                        idx if idx < doc_idx else idx - 1
-                        for idx in self.user_index[user_id] if idx != doc_idx
-                    ]
-                    if not self.user_index[user_id]:
-                        del self.user_index[user_id]
+                # Tombstone in place: indices of other documents stay valid, the slot and its embedding row are reused
+                tombstone = {"id": document_id, "deleted": True}
+                if 'embedding_row' in doc_to_delete:
+                    tombstone['embedding_row'] = doc_to_delete['embedding_row']
+                self.documents[doc_idx] = tombstone
+                self.free_rows.append(doc_idx)
+                self.user_index[user_id].remove(doc_idx)
+                if not self.user_index[user_id]:
+                    del self.user_index[user_id]
 
                 self._save_documents()
-                self.logger.info(f"Документ '{doc_to_delete.get('title', 'N/A')}' успешно удален")
-                return True
-
-            self.logger.warning(f"Документ с ID {document_id} не найден для user_id {user_id}")
-            return False
+                # Compaction renumbers rows on disk, so inside bulk() it waits for the metadata flush at the end of the block
+                if not self._bulk_depth and len(self.free_rows) > len(self.documents) // 4:
+                    self._compact()
+            self.logger.info(f"Документ '{doc_to_delete.get('title', 'N/A')}' успешно удален")
+            return True
         except Exception as e:
             self.logger.error(f"Ошибка при удалении документа: {e}", exc_info=True)
             return False
@@ -1,18 +1,103 @@
+import functools
+import httpx
 import openai
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 import os
 from dotenv import load_dotenv
 from utils.logger_config import setup_logger
 from utils.retry_handler import RetryHandler
+from utils.embedding_cache import EmbeddingCache
 
 load_dotenv()
 
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    import h2
+except ImportError:
+    h2 = None
+
+
+@functools.lru_cache(maxsize=None)
+def _get_client(api_key: Optional[str]) -> openai.OpenAI:
+    """Returns the process-wide OpenAI client: its connection pool keeps connections alive between requests and across
+    service instances, multiplexed over HTTP/2 when h2 is installed"""
+    return openai.OpenAI(
+        api_key=api_key,
+        http_client=openai.DefaultHttpxClient(
+            http2=h2 is not None,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=32, keepalive_expiry=300)
+        )
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding(model: str):
+    """Loads the tokenizer of a model once per process (cl100k_base for models tiktoken doesn't know); None if tiktoken or its BPE file is unavailable"""
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
+
+
+@functools.lru_cache(maxsize=4096)
+def _count_tokens(model: str, text: str) -> int:
+    """Counts the tokens of a short text; memoized because queries, summaries and chunks are counted repeatedly"""
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _keyword_matcher(words: set):
+    """Builds an Aho-Corasick automaton over the query words; None if pyahocorasick is not installed or there are no words"""
+    if ahocorasick is None or not words:
+        return None
+    automaton = ahocorasick.Automaton()
+    for word in words:
+        automaton.add_word(word, word)
+    automaton.make_automaton()
+    return automaton
+
+
+def _keyword_counts(text_lower: str, words: set, automaton) -> Tuple[int, int]:
+    """Returns (distinct words found, non-overlapping occurrences of all words) in text_lower, in one pass when automaton is given"""
+    if automaton is None:
+        return sum(1 for word in words if word in text_lower), sum(text_lower.count(word) for word in words)
+    # Matches arrive ordered by end offset; skipping overlaps per word reproduces str.count
+    next_start: Dict[str, int] = {}
+    occurrences = 0
+    for end, word in automaton.iter(text_lower):
+        start = end - len(word) + 1
+        if start >= next_start.get(word, 0):
+            next_start[word] = end + 1
+            occurrences += 1
+    return len(next_start), occurrences
+
 class OpenAIService:
     def __init__(self):
         self.logger = setup_logger("openai_service")
-        self.client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.client = _get_client(os.getenv("OPENAI_API_KEY"))
         self.model = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
         self.embedding_model = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+        self.token_cache_max_chars = 20000
+        # Every service in the process (bot, document store) works through the same cache
+        self.embedding_cache = EmbeddingCache.get_shared(
+            fuzzy=os.getenv("EMBEDDING_CACHE_FUZZY", "").lower() in ("1", "true", "yes")
+        )
         self.logger.info(f"OpenAI Service инициализирован с моделью {self.model}")
     
     @RetryHandler.exponential_backoff(max_retries=3)
@@ -45,7 +130,10 @@ class OpenAIService:
     
     @RetryHandler.exponential_backoff(max_retries=3)
     def get_embedding(self, text: str) -> List[float]:
-        """Gets embedding for text"""
+        """Gets embedding for text, from the embedding cache when it has been seen before"""
+        cached = self.embedding_cache.get(self.embedding_model, text)
+        if cached is not None:
+            return cached
         try:
             self.logger.debug(f"Получение эмбеддинга для текста (длина: {len(text)} символов)")
             response = self.client.embeddings.create(
@@ -53,21 +141,62 @@ class OpenAIService:
                 input=text
             )
             self.logger.info("Эмбеддинг успешно получен")
-            return response.data[0].embedding
+            embedding = response.data[0].embedding
+            self.embedding_cache.set(self.embedding_model, text, embedding)
+            return embedding
         except Exception as e:
             self.logger.error(f"Ошибка при получении эмбеддинга: {e}", exc_info=True)
             return []
     
+    @RetryHandler.exponential_backoff(max_retries=3)
+    def get_embeddings_batch(self, texts: List[str], batch_size: int = 256) -> List[List[float]]:
+        """Gets embeddings for several texts with one API request per batch_size texts, in input order; cached texts are not re-sent"""
+        if not texts:
+            return []
+        embeddings = [self.embedding_cache.get(self.embedding_model, text) for text in texts]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if not missing:
+            return embeddings
+        try:
+            for start in range(0, len(missing), batch_size):
+                batch = missing[start:start + batch_size]
+                self.logger.debug(f"Получение эмбеддингов для {len(batch)} текстов одним запросом")
+                response = self.client.embeddings.create(
+                    model=self.embedding_model,
+                    input=[texts[i] for i in batch]
+                )
+                self.logger.info(f"Получено {len(response.data)} эмбеддингов")
+                for i, item in zip(batch, sorted(response.data, key=lambda item: item.index)):
+                    embeddings[i] = item.embedding
+                    self.embedding_cache.set(self.embedding_model, texts[i], item.embedding)
+            return embeddings
+        except Exception as e:
+            self.logger.error(f"Ошибка при получении эмбеддингов: {e}", exc_info=True)
+            return []
+
     def estimate_tokens(self, text: str) -> int:
-        """Estimates token count using 1 token ≈ 4 characters approximation"""
-        return len(text) // 4
+        """Counts tokens with the model's tiktoken encoding, or estimates them as 1 token ≈ 4 characters if it is unavailable"""
+        # Whole documents are counted once and would only pin memory in the memo
+        if len(text) <= self.token_cache_max_chars:
+            return _count_tokens(self.model, text)
+        encoding = _get_encoding(self.model)
+        if encoding is None:
+            return len(text) // 4
+        return len(encoding.encode(text, disallowed_special=()))
 
     def truncate_text(self, text: str, max_tokens: int) -> str:
         """Truncates text to maximum token count"""
-        max_chars = max_tokens * 4
-        if len(text) <= max_chars:
+        encoding = _get_encoding(self.model)
+        if encoding is None:
+            max_chars = max_tokens * 4
+            if len(text) <= max_chars:
+                return text
+            return text[:max_chars] + "... [текст обрезан]"
+
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
             return text
-        return text[:max_chars] + "... [текст обрезан]"
+        return encoding.decode(tokens[:max_tokens]) + "... [текст обрезан]"
 
     def extract_relevant_chunks(self, text: str, query: str, max_chunks: int = 3, chunk_size: int = 2000) -> List[str]:
         """Extracts text chunks most relevant to the query using keyword matching and scoring"""
@@ -77,14 +206,14 @@ class OpenAIService:
         query_words = {w for w in query_words if w not in stop_words and len(w) > 2}
 
         paragraphs = text.split('\n\n')
+        matcher = _keyword_matcher(query_words)
 
         scored_paragraphs = []
         for para in paragraphs:
             if not para.strip():
                 continue
-            para_lower = para.lower()
-            score = sum(1 for word in query_words if word in para_lower)
-            score += sum(para_lower.count(word) for word in query_words) * 0.1
+            found, occurrences = _keyword_counts(para.lower(), query_words, matcher)
+            score = found + occurrences * 0.1
             if score > 0:
                 scored_paragraphs.append((score, para.strip()))
 
@@ -93,8 +222,7 @@ class OpenAIService:
             for sentence in sentences:
                 if not sentence.strip():
                     continue
-                sentence_lower = sentence.lower()
-                score = sum(1 for word in query_words if word in sentence_lower)
+                score, _ = _keyword_counts(sentence.lower(), query_words, matcher)
                 if score > 0:
                     scored_paragraphs.append((score, sentence.strip() + '.'))
 
@@ -122,10 +250,12 @@ class OpenAIService:
         return chunks
     
     @RetryHandler.exponential_backoff(max_retries=3)
-    def generate_answer(self, query: str, context: str, conversation_history: List[Dict[str, str]] = None, max_context_tokens: int = 60000) -> str:
-        """Generates an answer based on context and conversation history"""
+    def generate_answer(self, query: str, context: str, conversation_history: List[Dict[str, str]] = None,
+                        max_context_tokens: int = 60000, context_tokens: Optional[int] = None) -> str:
+        """Generates an answer based on context and conversation history (context_tokens skips re-counting the context)"""
         try:
-            context_tokens = self.estimate_tokens(context)
+            if context_tokens is None:
+                context_tokens = self.estimate_tokens(context)
             if context_tokens > max_context_tokens:
                 context = self.truncate_text(context, max_context_tokens)
                 self.logger.warning(f"Контекст обрезан с {context_tokens} до ~{max_context_tokens} токенов (экономия токенов)")
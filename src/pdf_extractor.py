@@ -1,37 +1,115 @@
 import io
-from typing import Optional
+import mmap
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, Optional, TextIO, Union
 import pypdf
 
+# PDFs with more pages than this are split across worker processes; smaller ones parse faster than the hand-off costs
+SEQUENTIAL_MAX_PAGES = 50
+
+# Size of the one extraction pool shared by the process, so concurrent uploads queue for the same workers
+PROCESS_POOL_MAX_WORKERS = min(4, os.cpu_count() or 1)
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+_process_pool_lock = threading.Lock()
+
+# Runs of 2+ spaces collapse to one space and runs of 3+ newlines to a paragraph break; single spaces never match,
+# and plain string replacements keep the substitution in C
+_MULTIPLE_SPACES = re.compile(r' {2,}')
+_MULTIPLE_NEWLINES = re.compile(r'\n{3,}')
+
+
+def _write_pages(pdf_reader: pypdf.PdfReader, start: int, stop: int, buffer: TextIO):
+    """Writes the text of pages [start, stop) to buffer, each followed by a blank line, skipping pages that fail or are empty"""
+    for page_num in range(start, stop):
+        try:
+            page_text = pdf_reader.pages[page_num].extract_text()
+            if page_text.strip():
+                buffer.write(page_text)
+                buffer.write("\n\n")
+        except Exception as e:
+            print(f"Ошибка при извлечении текста со страницы {page_num + 1}: {e}")
+
+
+def _extract_page_range(path: str, start: int, stop: int) -> str:
+    """Worker entry point: re-opens the PDF file in the worker process and extracts a page range"""
+    buffer = io.StringIO()
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as pdf_file:
+        _write_pages(pypdf.PdfReader(pdf_file), start, stop, buffer)
+    return buffer.getvalue()
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    """Returns the long-lived extraction pool, creating it on first use. Workers are spawned rather than forked: the bot
+    extracts from a worker thread while logging, history-writer and HTTP threads run, and a lock one of them holds at
+    fork time would stay locked forever in a forked child"""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(
+                max_workers=PROCESS_POOL_MAX_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _process_pool
+
+
 class PDFExtractor:
     """Class for extracting text from PDF files"""
 
     @staticmethod
     def extract_text_from_pdf(pdf_bytes: bytes) -> Optional[str]:
         """Extracts text from a PDF file"""
+        return PDFExtractor._extract_text(io.BytesIO(pdf_bytes), pdf_bytes)
+
+    @staticmethod
+    def extract_text_from_path(path: str) -> Optional[str]:
+        """Extracts text from a PDF file on disk, reading it through a memory map instead of loading it into memory"""
         try:
-            pdf_file = io.BytesIO(pdf_bytes)
-            pdf_reader = pypdf.PdfReader(pdf_file)
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as pdf_file:
+                return PDFExtractor._extract_text(pdf_file, path)
+        except (OSError, ValueError) as e:
+            print(f"Ошибка при открытии PDF {path}: {e}")
+            return None
 
-            text_parts = []
+    @staticmethod
+    def _extract_text(pdf_file: BinaryIO, source: Union[bytes, str]) -> Optional[str]:
+        """Extracts text from a seekable PDF stream; source (bytes or path) lets worker processes re-open long PDFs"""
+        try:
+            pdf_reader = pypdf.PdfReader(pdf_file)
             total_pages = len(pdf_reader.pages)
 
-            for page_num, page in enumerate(pdf_reader.pages, 1):
+            # Pages are streamed into one buffer instead of a list of page strings joined at the end
+            buffer = io.StringIO()
+            workers = min(PROCESS_POOL_MAX_WORKERS, total_pages)
+            if total_pages <= SEQUENTIAL_MAX_PAGES or workers < 2:
+                _write_pages(pdf_reader, 0, total_pages, buffer)
+            else:
+                # pypdf page parsing is pure Python and holds the GIL, so pages go to processes, one contiguous range each.
+                # Workers re-open the file by path: uploaded bytes are spilled to a temp file once instead of pickled per range
+                path = source
+                if isinstance(source, bytes):
+                    fd, path = tempfile.mkstemp(suffix=".pdf")
+                    with os.fdopen(fd, 'wb') as f:
+                        f.write(source)
                 try:
-                    page_text = page.extract_text()
-                    if page_text.strip():
-                        text_parts.append(page_text)
-                except Exception as e:
-                    print(f"Ошибка при извлечении текста со страницы {page_num}: {e}")
-                    continue
-
-            if not text_parts:
-                return None
+                    bounds = [total_pages * i // workers for i in range(workers + 1)]
+                    for part in _get_process_pool().map(_extract_page_range, [path] * workers, bounds[:-1], bounds[1:]):
+                        buffer.write(part)
+                finally:
+                    if path is not source:
+                        os.remove(path)
 
-            full_text = "\n\n".join(text_parts)
+            full_text = buffer.getvalue()
+            buffer.close()
+            if not full_text:
+                return None
 
-            import re
-            full_text = re.sub(r' +', ' ', full_text)
-            full_text = re.sub(r'\n{3,}', '\n\n', full_text)
+            full_text = _MULTIPLE_SPACES.sub(' ', full_text)
+            full_text = _MULTIPLE_NEWLINES.sub('\n\n', full_text)
 
             return full_text.strip()
 
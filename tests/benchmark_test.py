@@ -1,20 +1,93 @@
 """Automatic benchmarking system for RAG system - tests retrieval accuracy and answer quality"""
+import functools
+import io
 import json
 import time
-from typing import List, Dict, Tuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, FrozenSet, Optional, Set, Tuple
+import numpy as np
 from src.document_store_simple import DocumentStore
 from src.openai_service import OpenAIService
+from utils.cache_manager import CacheManager
 from utils.logger_config import setup_logger
-import statistics
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# One row per test for the running aggregates; quality columns are NaN for tests without a graded answer
+_RESULT_DTYPE = np.dtype([
+    ('precision', 'f8'), ('recall', 'f8'), ('f1', 'f8'),
+    ('retrieval_time', 'f8'), ('generation_time', 'f8'), ('total_time', 'f8'),
+    ('keyword_overlap', 'f8'), ('semantic_similarity', 'f8')
+])
+
+
+def _title_automaton(expected_titles: List[str]):
+    """Builds an Aho-Corasick automaton over the expected titles; None if pyahocorasick is not installed or there are none"""
+    if ahocorasick is None or not any(expected_titles):
+        return None
+    automaton = ahocorasick.Automaton()
+    for title in expected_titles:
+        if title:
+            automaton.add_word(title, title)
+    automaton.make_automaton()
+    return automaton
+
+
+def _matched_titles(title: str, expected_titles: List[str], automaton=None) -> Set[str]:
+    """Returns the expected titles contained in title, in one pass when automaton is given"""
+    if automaton is None:
+        return {exp for exp in expected_titles if exp in title}
+    matched = {exp for _, exp in automaton.iter(title)} if title else set()
+    if '' in expected_titles:
+        matched.add('')
+    return matched
+
+
+@functools.lru_cache(maxsize=8192)
+def _tokenize(text: str) -> FrozenSet[str]:
+    """Distinct lowercased words of a text; cached, as the same ground truths are scored on every run"""
+    return frozenset(text.lower().split())
+
 
 class RAGBenchmark:
     """System for automatic RAG benchmarking"""
 
-    def __init__(self, document_store: DocumentStore, openai_service: OpenAIService):
+    # user_id under which grading scores are stored in score_cache (Telegram user ids are never 0)
+    SCORE_CACHE_USER_ID = 0
+
+    def __init__(self, document_store: DocumentStore, openai_service: OpenAIService,
+                 score_cache: Optional[CacheManager] = None, semantic_score_cache: bool = True):
         self.logger = setup_logger("benchmark")
         self.document_store = document_store
         self.openai_service = openai_service
-        self.results = []
+        # LLM grading scores keyed by (generated answer, ground truth), kept for 30 days across runs. With semantic_score_cache
+        # a generated answer whose embedding is within 0.98 cosine of an already graded one for the same ground truth reuses its score
+        self.score_cache = score_cache or CacheManager.get_shared(
+            cache_dir="benchmark_cache", ttl=30 * 24 * 3600, similarity_threshold=0.98
+        )
+        self.semantic_score_cache = semantic_score_cache
+        # Only the last max_kept_results results stay in memory; metrics are kept as running aggregates
+        self.max_kept_results = 100
+        self.results: "deque[Dict]" = deque(maxlen=self.max_kept_results)
+        self._running = self._empty_running()
+        # Tests run and graded per chunk before their results are folded into the aggregates
+        self.chunk_size = 256
+        # Test cases are network-bound (answer generation + LLM grading), so they run concurrently
+        self.max_workers = 16
+        # Answer pairs graded per LLM request
+        self.judge_batch_size = 20
+        # Characters of retrieved text given to the LLM: per document and in total, so prompt sizes stay comparable
+        self.doc_context_chars = 2000
+        self.max_context_chars = 6000
 
     def load_test_dataset(self, filepath: str) -> List[Dict]:
         """Loads test dataset from JSON file"""
@@ -27,24 +100,30 @@ class RAGBenchmark:
             self.logger.error(f"Ошибка при загрузке датасета: {e}")
             return []
 
-    def calculate_retrieval_precision(self, retrieved_docs: List[Dict], expected_titles: List[str]) -> float:
+    def calculate_retrieval_precision(self, retrieved_docs: List[Dict], expected_titles: List[str],
+                                      automaton=None) -> float:
         """Calculates precision: relevant retrieved / total retrieved"""
         if not retrieved_docs:
             return 0.0
 
         retrieved_titles = [doc.get('title', '') for doc in retrieved_docs]
-        relevant_retrieved = sum(1 for title in retrieved_titles if any(exp in title for exp in expected_titles))
+        relevant_retrieved = sum(
+            1 for title in retrieved_titles if _matched_titles(title, expected_titles, automaton)
+        )
 
         precision = relevant_retrieved / len(retrieved_docs)
         return precision
 
-    def calculate_retrieval_recall(self, retrieved_docs: List[Dict], expected_titles: List[str]) -> float:
+    def calculate_retrieval_recall(self, retrieved_docs: List[Dict], expected_titles: List[str],
+                                   automaton=None) -> float:
         """Calculates recall: relevant retrieved / total relevant"""
         if not expected_titles:
             return 1.0
 
-        retrieved_titles = [doc.get('title', '') for doc in retrieved_docs]
-        relevant_retrieved = sum(1 for exp in expected_titles if any(exp in title for title in retrieved_titles))
+        found: Set[str] = set()
+        for doc in retrieved_docs:
+            found |= _matched_titles(doc.get('title', ''), expected_titles, automaton)
+        relevant_retrieved = sum(1 for exp in expected_titles if exp in found)
 
         recall = relevant_retrieved / len(expected_titles)
         return recall
@@ -57,31 +136,96 @@ class RAGBenchmark:
 
     def evaluate_answer_quality(self, generated_answer: str, ground_truth: str) -> Dict[str, float]:
         """Evaluates answer quality using keyword overlap, length similarity, and semantic similarity"""
-        gen_keywords = set(generated_answer.lower().split())
-        truth_keywords = set(ground_truth.lower().split())
-        keyword_overlap = len(gen_keywords & truth_keywords) / max(len(truth_keywords), 1)
-
-        len_similarity = min(len(generated_answer), len(ground_truth)) / max(len(generated_answer), len(ground_truth), 1)
-        semantic_score = self._evaluate_semantic_similarity(generated_answer, ground_truth)
-
         return {
-            'keyword_overlap': keyword_overlap,
-            'length_similarity': len_similarity,
-            'semantic_similarity': semantic_score
+            'keyword_overlap': float(self._batch_keyword_overlap([generated_answer], [ground_truth])[0]),
+            'length_similarity': self._length_similarity(generated_answer, ground_truth),
+            'semantic_similarity': self._evaluate_semantic_similarity(generated_answer, ground_truth)
         }
 
+    def _length_similarity(self, generated_answer: str, ground_truth: str) -> float:
+        """Ratio of the shorter answer's length to the longer one's"""
+        return min(len(generated_answer), len(ground_truth)) / max(len(generated_answer), len(ground_truth), 1)
+
+    def _batch_keyword_overlap(self, generated_answers: List[str], ground_truths: List[str]) -> np.ndarray:
+        """Share of distinct ground-truth words found in each generated answer, for all pairs at once.
+        Each (pair, word id) becomes one int64 key, so set intersection is a single sorted-array intersect"""
+        pair_count = len(generated_answers)
+        texts = [_tokenize(text) for text in generated_answers + ground_truths]
+        if not any(texts):
+            return np.zeros(pair_count)
+
+        _, word_ids = np.unique(np.array([word for words in texts for word in words]), return_inverse=True)
+        vocabulary_size = int(word_ids.max()) + 1
+        text_ids = np.repeat(np.arange(len(texts)), [len(words) for words in texts])
+        keys = (text_ids % pair_count) * vocabulary_size + word_ids.ravel()
+
+        generated_keys = np.unique(keys[text_ids < pair_count])
+        truth_keys = np.unique(keys[text_ids >= pair_count])
+        common_keys = np.intersect1d(generated_keys, truth_keys, assume_unique=True)
+        common = np.bincount(common_keys // vocabulary_size, minlength=pair_count)
+        truth_sizes = np.bincount(truth_keys // vocabulary_size, minlength=pair_count)
+        return common / np.maximum(truth_sizes, 1)
+
     def _evaluate_semantic_similarity(self, generated: str, ground_truth: str) -> float:
-        """Uses LLM to evaluate semantic similarity of answers"""
+        """Uses LLM to evaluate semantic similarity of answers, reusing cached scores of identical or near-identical pairs"""
+        return self._evaluate_semantic_similarity_batch([(generated, ground_truth)])[0]
+
+    def _evaluate_semantic_similarity_batch(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        """Semantic similarity of (generated, ground truth) pairs: cached scores are reused, the rest are graded
+        judge_batch_size pairs per LLM request"""
+        scores: List[Optional[float]] = [None] * len(pairs)
+        for i, (generated, ground_truth) in enumerate(pairs):
+            cached_score = self.score_cache.get(generated, ground_truth, self.SCORE_CACHE_USER_ID)
+            if cached_score is not None:
+                scores[i] = float(cached_score)
+
+        missing = [i for i, score in enumerate(scores) if score is None]
+        embeddings: Dict[int, List[float]] = {}
+        if missing and self.semantic_score_cache:
+            try:
+                batch_embeddings = self.openai_service.get_embeddings_batch([pairs[i][0] for i in missing])
+            except Exception as e:
+                self.logger.warning(f"Ошибка при получении эмбеддингов ответов: {e}")
+                batch_embeddings = []
+            for i, embedding in zip(missing, batch_embeddings):
+                if not embedding:
+                    continue
+                embeddings[i] = embedding
+                cached_score = self.score_cache.get(
+                    pairs[i][0], pairs[i][1], self.SCORE_CACHE_USER_ID, query_embedding=embedding
+                )
+                if cached_score is not None:
+                    scores[i] = float(cached_score)
+            missing = [i for i in missing if scores[i] is None]
+
+        chunks = [missing[start:start + self.judge_batch_size] for start in range(0, len(missing), self.judge_batch_size)]
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(chunks)))) as executor:
+            judged = executor.map(lambda chunk: self._judge([pairs[i] for i in chunk]), chunks)
+            for chunk, chunk_scores in zip(chunks, judged):
+                for i, score in zip(chunk, chunk_scores):
+                    scores[i] = score
+                    if score is not None:
+                        self.score_cache.set(
+                            pairs[i][0], pairs[i][1], self.SCORE_CACHE_USER_ID, str(score),
+                            query_embedding=embeddings.get(i)
+                        )
+
+        return [0.5 if score is None else score for score in scores]
+
+    def _judge(self, pairs: List[Tuple[str, str]]) -> List[Optional[float]]:
+        """Grades several answer pairs with one LLM request; None for every pair if the request or its JSON fails"""
         try:
-            prompt = f"""Оцени семантическую схожесть двух ответов по шкале от 0 до 1.
+            listed = "\n\n".join(
+                f"[{i}]\nОтвет 1 (сгенерированный): {generated}\nОтвет 2 (эталонный): {ground_truth}"
+                for i, (generated, ground_truth) in enumerate(pairs)
+            )
+            prompt = f"""Оцени семантическую схожесть ответов в каждой паре по шкале от 0 до 1.
 0 = полностью разные ответы
 1 = идентичные по смыслу ответы
 
-Ответ 1 (сгенерированный): {generated}
-
-Ответ 2 (эталонный): {ground_truth}
+{listed}
 
-Верни только число от 0 до 1."""
+Верни JSON-объект вида {{"scores": [...]}}: ровно {len(pairs)} чисел от 0 до 1, по одному на пару, в том же порядке."""
 
             response = self.openai_service.client.chat.completions.create(
                 model="gpt-4o-mini",
@@ -90,15 +234,17 @@ class RAGBenchmark:
                     {"role": "user", "content": prompt}
                 ],
                 temperature=0.0,
-                max_tokens=10
+                max_tokens=20 + 8 * len(pairs),
+                response_format={"type": "json_object"}
             )
 
-            score_text = response.choices[0].message.content.strip()
-            score = float(score_text.split()[0])
-            return min(max(score, 0.0), 1.0)
+            scores = json.loads(response.choices[0].message.content)['scores']
+            if len(scores) != len(pairs):
+                raise ValueError(f"ожидалось {len(pairs)} оценок, получено {len(scores)}")
+            return [min(max(float(score), 0.0), 1.0) for score in scores]
         except Exception as e:
             self.logger.warning(f"Ошибка при оценке семантической схожести: {e}")
-            return 0.5
+            return [None] * len(pairs)
 
     def run_single_test(self, test_case: Dict, user_id: int) -> Dict:
         """Runs a single test"""
@@ -112,19 +258,31 @@ class RAGBenchmark:
         retrieved_docs = self.document_store.search_documents(question, user_id, top_k=3)
         retrieval_time = time.time() - start_time
 
-        precision = self.calculate_retrieval_precision(retrieved_docs, expected_titles)
-        recall = self.calculate_retrieval_recall(retrieved_docs, expected_titles)
+        # Both metrics scan the retrieved titles with one automaton built per test case
+        automaton = _title_automaton(expected_titles)
+        precision = self.calculate_retrieval_precision(retrieved_docs, expected_titles, automaton)
+        recall = self.calculate_retrieval_recall(retrieved_docs, expected_titles, automaton)
         f1_score = self.calculate_f1_score(precision, recall)
 
         if retrieved_docs:
-            context = "\n\n".join([doc['full_text'][:2000] for doc in retrieved_docs])
+            context_buffer = io.StringIO()
+            budget = self.max_context_chars
+            for doc in retrieved_docs:
+                if budget <= 0:
+                    break
+                if context_buffer.tell():
+                    context_buffer.write("\n\n")
+                part = doc['full_text'][:min(self.doc_context_chars, budget)]
+                context_buffer.write(part)
+                budget -= len(part)
+            context = context_buffer.getvalue()
             start_time = time.time()
             generated_answer = self.openai_service.generate_answer(question, context)
             generation_time = time.time() - start_time
 
-            # Evaluate answer quality
+            # Evaluate answer quality (keyword overlap and semantic similarity are added by run_benchmark for all tests at once)
             if ground_truth:
-                answer_quality = self.evaluate_answer_quality(generated_answer, ground_truth)
+                answer_quality = {'length_similarity': self._length_similarity(generated_answer, ground_truth)}
             else:
                 answer_quality = None
         else:
@@ -147,68 +305,147 @@ class RAGBenchmark:
 
         return result
 
-    def run_benchmark(self, test_dataset: List[Dict], user_id: int) -> Dict:
+    def run_benchmark(self, test_dataset: List[Dict], user_id: int, results_path: Optional[str] = None) -> Dict:
         """
         Runs full benchmark on dataset
 
+        Args:
+            results_path: NDJSON file every individual result is streamed to (optional)
+
         Returns:
             Dictionary with aggregated metrics
         """
         self.logger.info(f"Запуск бенчмарка на {len(test_dataset)} тестовых вопросах")
-        self.results = []
+        self.results = deque(maxlen=self.max_kept_results)
+        self._running = self._empty_running()
 
-        for i, test_case in enumerate(test_dataset, 1):
+        def run_numbered_test(numbered: Tuple[int, Dict]) -> Dict:
+            i, test_case = numbered
             self.logger.info(f"Тест {i}/{len(test_dataset)}")
-            result = self.run_single_test(test_case, user_id)
-            self.results.append(result)
+            return self.run_single_test(test_case, user_id)
+
+        stream = open(results_path, 'wb') if results_path else None
+        try:
+            # Tests run and are graded chunk_size at a time; each chunk is folded into the running aggregates and streamed out
+            with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(test_dataset)))) as executor:
+                for start in range(0, len(test_dataset), self.chunk_size):
+                    chunk = test_dataset[start:start + self.chunk_size]
+                    # map keeps results in dataset order
+                    results = list(executor.map(run_numbered_test, enumerate(chunk, start + 1)))
+                    self._grade_answers(results, chunk)
+                    self._accumulate(results)
+                    if stream is not None:
+                        stream.write(b"".join(self._encode_result(result) for result in results))
+                    self.results.extend(results)
+        finally:
+            if stream is not None:
+                stream.close()
+                self.logger.info(f"Результаты тестов записаны в {results_path}")
 
         # Aggregate results
         aggregated = self._aggregate_results()
         return aggregated
 
+    def _grade_answers(self, results: List[Dict], test_cases: List[Dict]):
+        """Adds batched keyword overlap and semantic similarity to the answer quality of graded results"""
+        graded = [
+            (result, test_case.get('ground_truth_answer', ''))
+            for result, test_case in zip(results, test_cases) if result['answer_quality'] is not None
+        ]
+        if not graded:
+            return
+        pairs = [(result['generated_answer'], truth) for result, truth in graded]
+        overlaps = self._batch_keyword_overlap([generated for generated, _ in pairs], [truth for _, truth in pairs])
+        semantic_scores = self._evaluate_semantic_similarity_batch(pairs)
+        for (result, _), overlap, semantic_score in zip(graded, overlaps, semantic_scores):
+            result['answer_quality'] = {
+                'keyword_overlap': float(overlap),
+                **result['answer_quality'],
+                'semantic_similarity': semantic_score
+            }
+
+    def _encode_result(self, result: Dict) -> bytes:
+        """Encodes a result as one NDJSON line"""
+        if orjson is not None:
+            return orjson.dumps(result) + b"\n"
+        return (json.dumps(result, ensure_ascii=False) + "\n").encode('utf-8')
+
+    def _empty_running(self) -> Dict:
+        """Running aggregates before any test: column sums over _RESULT_DTYPE, test counts and retrieval time range"""
+        return {
+            'sum': np.zeros(len(_RESULT_DTYPE.names)),
+            'count': 0,
+            'graded': 0,
+            'max_retrieval_time': -np.inf,
+            'min_retrieval_time': np.inf
+        }
+
+    def _accumulate(self, results: List[Dict]):
+        """Folds a chunk of results into the running aggregates"""
+        if not results:
+            return
+
+        rows = np.fromiter(
+            (
+                (
+                    r['retrieval_precision'], r['retrieval_recall'], r['f1_score'],
+                    r['retrieval_time'], r['generation_time'], r['total_time'],
+                    r['answer_quality']['keyword_overlap'] if r['answer_quality'] else np.nan,
+                    r['answer_quality']['semantic_similarity'] if r['answer_quality'] else np.nan
+                )
+                for r in results
+            ),
+            dtype=_RESULT_DTYPE,
+            count=len(results)
+        )
+
+        # All columns are f8, so the rows can be summed as one 2-D array; quality columns skip ungraded tests
+        running = self._running
+        running['sum'] += np.nansum(rows.view(np.float64).reshape(len(rows), -1), axis=0)
+        running['count'] += len(rows)
+        running['graded'] += int(np.count_nonzero(~np.isnan(rows['keyword_overlap'])))
+        running['max_retrieval_time'] = max(running['max_retrieval_time'], float(rows['retrieval_time'].max()))
+        running['min_retrieval_time'] = min(running['min_retrieval_time'], float(rows['retrieval_time'].min()))
+
     def _aggregate_results(self) -> Dict:
         """Aggregates results from all tests"""
-        if not self.results:
+        running = self._running
+        if not running['count']:
             return {}
 
-        precisions = [r['retrieval_precision'] for r in self.results]
-        recalls = [r['retrieval_recall'] for r in self.results]
-        f1_scores = [r['f1_score'] for r in self.results]
-        retrieval_times = [r['retrieval_time'] for r in self.results]
-        generation_times = [r['generation_time'] for r in self.results]
-        total_times = [r['total_time'] for r in self.results]
+        means = dict(zip(_RESULT_DTYPE.names, running['sum'] / running['count']))
 
         # Aggregate answer quality metrics
-        answer_qualities = [r['answer_quality'] for r in self.results if r['answer_quality']]
-        if answer_qualities:
-            avg_keyword_overlap = statistics.mean([q['keyword_overlap'] for q in answer_qualities])
-            avg_semantic_similarity = statistics.mean([q['semantic_similarity'] for q in answer_qualities])
+        if running['graded']:
+            quality = dict(zip(_RESULT_DTYPE.names, running['sum'] / running['graded']))
+            avg_keyword_overlap = float(quality['keyword_overlap'])
+            avg_semantic_similarity = float(quality['semantic_similarity'])
         else:
             avg_keyword_overlap = 0.0
             avg_semantic_similarity = 0.0
 
         aggregated = {
-            'total_tests': len(self.results),
-            'avg_retrieval_precision': statistics.mean(precisions),
-            'avg_retrieval_recall': statistics.mean(recalls),
-            'avg_f1_score': statistics.mean(f1_scores),
-            'avg_retrieval_time': statistics.mean(retrieval_times),
-            'avg_generation_time': statistics.mean(generation_times),
-            'avg_total_time': statistics.mean(total_times),
+            'total_tests': running['count'],
+            'avg_retrieval_precision': float(means['precision']),
+            'avg_retrieval_recall': float(means['recall']),
+            'avg_f1_score': float(means['f1']),
+            'avg_retrieval_time': float(means['retrieval_time']),
+            'avg_generation_time': float(means['generation_time']),
+            'avg_total_time': float(means['total_time']),
             'avg_keyword_overlap': avg_keyword_overlap,
             'avg_semantic_similarity': avg_semantic_similarity,
-            'max_retrieval_time': max(retrieval_times),
-            'min_retrieval_time': min(retrieval_times),
+            'max_retrieval_time': running['max_retrieval_time'],
+            'min_retrieval_time': running['min_retrieval_time'],
         }
 
         return aggregated
 
     def save_results(self, filepath: str):
-        """Saves benchmark results to JSON"""
+        """Saves aggregated metrics and the last max_kept_results results to JSON (all results are streamed by run_benchmark)"""
         try:
             output = {
                 'aggregated_metrics': self._aggregate_results(),
-                'individual_results': self.results
+                'individual_results': list(self.results)
             }
 
             with open(filepath, 'w', encoding='utf-8') as f:
@@ -220,7 +457,7 @@ class RAGBenchmark:
 
     def print_summary(self):
         """Prints brief summary of results"""
-        if not self.results:
+        if not self._running['count']:
             print("Нет результатов для отображения")
             return
 
@@ -260,7 +497,7 @@ def run_example_benchmark():
 
     if test_dataset:
         # Run benchmark (using test user with ID 999999)
-        results = benchmark.run_benchmark(test_dataset, user_id=999999)
+        results = benchmark.run_benchmark(test_dataset, user_id=999999, results_path='benchmark_results.ndjson')
 
         # Print results
         benchmark.print_summary()
@@ -40,6 +40,23 @@ def main():
     faiss_installed = check_package("faiss-cpu", "faiss")
     results.append(faiss_installed)
     
+    print()
+
+    # Опциональные ускорители (без них используется стандартная реализация)
+    optional_packages = [
+        ("orjson", "orjson"),
+        ("charset-normalizer", "charset_normalizer"),
+        ("tiktoken", "tiktoken"),
+        ("simsimd", "simsimd"),
+        ("pyahocorasick", "ahocorasick"),
+        ("h2", "h2"),
+        ("blake3", "blake3"),
+        ("hyperscan", "hyperscan"),
+        ("numba", "numba"),
+    ]
+    for package, import_name in optional_packages:
+        check_package(package, import_name)
+
     print()
     print("=" * 50)
     
@@ -0,0 +1,77 @@
+"""Recall of the FAISS document store against brute-force inner product over the same embeddings"""
+import numpy as np
+import pytest
+
+faiss = pytest.importorskip("faiss")
+import src.document_store as document_store
+
+DIM = 1536
+
+class FakeOpenAIService:
+    """Stands in for OpenAIService: the summary is the text itself and embeddings come from a fixed table"""
+
+    vectors = {}
+
+    def summarize_document(self, text: str, max_length: int = 500) -> str:
+        return text
+
+    def get_embeddings_batch(self, texts, batch_size: int = 256):
+        return [self.vectors[text] for text in texts]
+
+    def get_embedding(self, text: str):
+        return self.vectors[text]
+
+@pytest.fixture
+def store_factory(tmp_path, monkeypatch):
+    FakeOpenAIService.vectors = {}
+    monkeypatch.setattr(document_store, "OpenAIService", FakeOpenAIService)
+    return lambda: document_store.DocumentStore(str(tmp_path / "documents"))
+
+def _add(store, vectors: np.ndarray, start: int, user_id: int = 1):
+    """Adds one document per vector, titled T<number>"""
+    batch = []
+    for offset, vector in enumerate(vectors):
+        number = start + offset
+        FakeOpenAIService.vectors[f"text {number}"] = vector.tolist()
+        batch.append((f"d{number}", f"T{number}", f"text {number}", user_id))
+    assert store.add_documents(batch)
+
+def _brute_force(store, query: np.ndarray, top_k: int, user_id: int = 1):
+    """Returns the titles of the top_k documents of a user by exact inner product"""
+    docs = [doc for doc in store.documents if doc.get('user_id') == user_id]
+    matrix = np.asarray([FakeOpenAIService.vectors[doc['summary']] for doc in docs], dtype=np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    scores = matrix @ (query / np.linalg.norm(query))
+    return [docs[i]['title'] for i in np.argsort(-scores, kind='stable')[:top_k]]
+
+def _search(store, query: np.ndarray, top_k: int, user_id: int = 1):
+    return [result['title'] for result in store.search_documents("", user_id, top_k=top_k, query_embedding=query.tolist())]
+
+def test_sq8_search_matches_brute_force(store_factory):
+    rng = np.random.default_rng(0)
+    store = store_factory()
+    _add(store, rng.standard_normal((320, DIM)).astype(np.float32), 0)
+    for number in rng.choice(320, size=40, replace=False):
+        assert store.delete_document(f"d{number}", 1)
+    _add(store, rng.standard_normal((40, DIM)).astype(np.float32), 320)
+
+    store = store_factory()
+    assert isinstance(faiss.downcast_index(store.indices[1].index), faiss.IndexScalarQuantizer)
+    for _ in range(50):
+        query = rng.standard_normal(DIM).astype(np.float32)
+        assert _search(store, query, 3) == _brute_force(store, query, 3)
+
+def test_ivf_search_matches_brute_force(store_factory):
+    rng = np.random.default_rng(1)
+    store = store_factory()
+    store.sq_min_vectors = 64
+    store.ivf_threshold = 512
+    # Embeddings of real documents cluster by topic; the noise puts neighbours close enough for IVF-SQ8 to misorder them
+    centers = rng.standard_normal((32, DIM)).astype(np.float32)
+    topics = rng.integers(0, len(centers), size=1200)
+    _add(store, centers[topics] + 2 * rng.standard_normal((1200, DIM)).astype(np.float32), 0)
+    assert isinstance(faiss.downcast_index(store.indices[1].index), faiss.IndexIVF)
+
+    for topic in rng.integers(0, len(centers), size=50):
+        query = centers[topic] + 2 * rng.standard_normal(DIM).astype(np.float32)
+        assert _search(store, query, 5) == _brute_force(store, query, 5)
@@ -1,42 +1,135 @@
+import functools
 import json
 import os
 import hashlib
+import threading
 import time
-from typing import Optional, Any
+from collections import OrderedDict
+from typing import Optional, Any, Dict, List, Tuple
+import numpy as np
 from utils.logger_config import setup_logger
 
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _new_hasher():
+    """Returns a BLAKE3 hasher when blake3 is installed, otherwise BLAKE2b; both are much faster than SHA-256 and give 32-byte digests"""
+    if blake3 is not None:
+        return blake3.blake3()
+    return hashlib.blake2b(digest_size=32)
+
+# Process-wide instances handed out by CacheManager.get_shared, keyed by their settings
+_shared_instances: Dict[tuple, "CacheManager"] = {}
+_shared_lock = threading.Lock()
+
 class CacheManager:
     """Cache manager for question answers"""
 
-    def __init__(self, cache_dir: str = "cache", ttl: int = 3600):
+    def __init__(self, cache_dir: str = "cache", ttl: int = 3600,
+                 similarity_threshold: float = 0.95, max_semantic_entries: int = 1024,
+                 max_memory_entries: int = 1024):
         self.logger = setup_logger("cache_manager")
         self.cache_dir = os.getenv("CACHE_DIR", cache_dir)
         self.ttl = ttl
+        # The same context is hashed by get(), set() and the semantic layer, and reused across questions in a session
+        self._hash_context = functools.lru_cache(maxsize=256)(self._compute_context_hash)
+
+        # In-memory LRU of key -> (answer, timestamp) in front of the cache files
+        self.max_memory_entries = max_memory_entries
+        self._memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._memory_lock = threading.Lock()
+
+        # Semantic layer: normalized embeddings of answered queries with parallel metadata lists
+        self.similarity_threshold = similarity_threshold
+        self.max_semantic_entries = max_semantic_entries
+        self._semantic_embeddings = np.empty((0, 0), dtype=np.float32)
+        self._semantic_answers: List[str] = []
+        self._semantic_context_hashes: List[str] = []
+        self._semantic_user_ids: List[int] = []
+        self._semantic_timestamps: List[float] = []
+        self._semantic_lock = threading.Lock()
 
         os.makedirs(self.cache_dir, exist_ok=True)
         self.logger.info(f"CacheManager инициализирован (TTL: {ttl}s, dir: {self.cache_dir})")
 
+    @classmethod
+    def get_shared(cls, cache_dir: str = "cache", ttl: int = 3600,
+                   similarity_threshold: float = 0.95, max_semantic_entries: int = 1024,
+                   max_memory_entries: int = 1024) -> "CacheManager":
+        """Returns the process-wide CacheManager with these settings, creating it on first use, so callers share one warm cache"""
+        key = (os.path.abspath(os.getenv("CACHE_DIR", cache_dir)), ttl, similarity_threshold,
+               max_semantic_entries, max_memory_entries)
+        with _shared_lock:
+            instance = _shared_instances.get(key)
+            if instance is None:
+                instance = cls(cache_dir, ttl, similarity_threshold, max_semantic_entries, max_memory_entries)
+                _shared_instances[key] = instance
+            return instance
+
     def _generate_key(self, query: str, context: str, user_id: int) -> str:
         """Generates a unique cache key based on query, context, and user_id"""
-        composite_key = f"{user_id}:{query}:{context}"
-        return hashlib.sha256(composite_key.encode('utf-8')).hexdigest()
+        return self.generate_key_from_ids(query, self._hash_context(context), user_id)
+
+    def generate_key_from_ids(self, query: str, context_hash: str, user_id: int) -> str:
+        """Generates the cache key from an already computed context digest, so a long context is not hashed again"""
+        hasher = _new_hasher()
+        hasher.update(f"{user_id}:{context_hash}:".encode('utf-8'))
+        hasher.update(query.encode('utf-8'))
+        return hasher.hexdigest()
+
+    def _compute_context_hash(self, context: str) -> str:
+        """Returns a digest of the context; used through the memoized _hash_context"""
+        hasher = _new_hasher()
+        hasher.update(context.encode('utf-8'))
+        return hasher.hexdigest()
+
+    def _remember(self, key: str, answer: str, timestamp: float):
+        """Puts an answer into the in-memory LRU, evicting the least recently used entry when full"""
+        with self._memory_lock:
+            self._memory[key] = (answer, timestamp)
+            self._memory.move_to_end(key)
+            if len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
 
     def _get_cache_path(self, key: str) -> str:
         """Returns the path to the cache file"""
         return os.path.join(self.cache_dir, f"{key}.json")
 
-    def get(self, query: str, context: str, user_id: int) -> Optional[str]:
-        """Retrieves answer from cache if it exists and is not expired"""
+    def get(self, query: str, context: str, user_id: int,
+            query_embedding: Optional[List[float]] = None) -> Optional[str]:
+        """Retrieves answer from cache if it exists and is not expired; with query_embedding, falls back to semantic match"""
         key = self._generate_key(query, context, user_id)
         cache_path = self._get_cache_path(key)
 
+        with self._memory_lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                answer, timestamp = entry
+                if time.time() - timestamp <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self.logger.debug(f"Кэш найден в памяти для ключа {key[:16]}...")
+                    return answer
+                del self._memory[key]
+
         if not os.path.exists(cache_path):
             self.logger.debug(f"Кэш не найден для ключа {key[:16]}...")
+            if query_embedding:
+                with self._semantic_lock:
+                    return self._semantic_get(query_embedding, context, user_id)
             return None
 
         try:
-            with open(cache_path, 'r', encoding='utf-8') as f:
-                cache_data = json.load(f)
+            with open(cache_path, 'rb') as f:
+                data = f.read()
+            cache_data = orjson.loads(data) if orjson is not None else json.loads(data)
 
             timestamp = cache_data.get('timestamp', 0)
             current_time = time.time()
@@ -47,6 +140,8 @@ class CacheManager:
                 return None
 
             answer = cache_data.get('answer')
+            if answer is not None:
+                self._remember(key, answer, timestamp)
             self.logger.info(f"Кэш найден для ключа {key[:16]}... (возраст: {current_time - timestamp:.0f}s)")
             return answer
 
@@ -58,8 +153,9 @@ class CacheManager:
                 pass
             return None
 
-    def set(self, query: str, context: str, user_id: int, answer: str) -> bool:
-        """Saves answer to cache"""
+    def set(self, query: str, context: str, user_id: int, answer: str,
+            query_embedding: Optional[List[float]] = None) -> bool:
+        """Saves answer to cache (and to the semantic layer when query_embedding is given)"""
         key = self._generate_key(query, context, user_id)
         cache_path = self._get_cache_path(key)
 
@@ -71,8 +167,23 @@ class CacheManager:
                 'user_id': user_id
             }
 
-            with open(cache_path, 'w', encoding='utf-8') as f:
-                json.dump(cache_data, f, ensure_ascii=False, indent=2)
+            # Compact UTF-8 JSON: orjson when installed, otherwise the stdlib encoder without indentation
+            if orjson is not None:
+                data = orjson.dumps(cache_data)
+            else:
+                data = json.dumps(cache_data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            # Written to a per-thread temp file and renamed over the entry, so readers never see a torn file
+            tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            # mtime mirrors the timestamp, so TTL scans need only stat(), not a JSON parse
+            os.utime(tmp_path, (cache_data['timestamp'], cache_data['timestamp']))
+            os.replace(tmp_path, cache_path)
+            self._remember(key, answer, cache_data['timestamp'])
+
+            if query_embedding:
+                with self._semantic_lock:
+                    self._semantic_add(query_embedding, context, user_id, answer, cache_data['timestamp'])
 
             self.logger.info(f"Ответ сохранен в кэш для ключа {key[:16]}...")
             return True
@@ -81,32 +192,81 @@ class CacheManager:
             self.logger.error(f"Ошибка при сохранении в кэш: {e}", exc_info=True)
             return False
 
+    def _semantic_get(self, query_embedding: List[float], context: str, user_id: int) -> Optional[str]:
+        """Returns a cached answer whose query embedding is within similarity_threshold (cosine) of this one"""
+        if not self._semantic_answers:
+            return None
+
+        query_vector = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query_vector)
+        if norm == 0 or query_vector.shape[0] != self._semantic_embeddings.shape[1]:
+            return None
+
+        scores = self._semantic_embeddings @ (query_vector / norm)
+        context_hash = self._hash_context(context)
+        current_time = time.time()
+
+        # Only the 5 best matches are checked: select them in O(n), then order just those
+        candidates = np.argpartition(-scores, 4)[:5] if len(scores) > 5 else np.arange(len(scores))
+        for idx in candidates[np.argsort(-scores[candidates])]:
+            score = float(scores[idx])
+            if score < self.similarity_threshold:
+                break
+            if (self._semantic_user_ids[idx] == user_id
+                    and self._semantic_context_hashes[idx] == context_hash
+                    and current_time - self._semantic_timestamps[idx] <= self.ttl):
+                self.logger.info(f"Семантический кэш найден (сходство: {score:.3f})")
+                return self._semantic_answers[idx]
+
+        self.logger.debug("Семантический кэш не найден")
+        return None
+
+    def _semantic_add(self, query_embedding: List[float], context: str, user_id: int, answer: str, timestamp: float):
+        """Adds an answered query to the semantic layer, evicting the oldest entry when full"""
+        query_vector = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query_vector)
+        if norm == 0:
+            return
+
+        row = (query_vector / norm).reshape(1, -1)
+        if self._semantic_answers and row.shape[1] == self._semantic_embeddings.shape[1]:
+            self._semantic_embeddings = np.vstack([self._semantic_embeddings, row])
+        else:
+            self._semantic_embeddings = row
+            self._semantic_answers = []
+            self._semantic_context_hashes = []
+            self._semantic_user_ids = []
+            self._semantic_timestamps = []
+
+        self._semantic_answers.append(answer)
+        self._semantic_context_hashes.append(self._hash_context(context))
+        self._semantic_user_ids.append(user_id)
+        self._semantic_timestamps.append(timestamp)
+
+        if len(self._semantic_answers) > self.max_semantic_entries:
+            self._semantic_embeddings = self._semantic_embeddings[1:]
+            del self._semantic_answers[0]
+            del self._semantic_context_hashes[0]
+            del self._semantic_user_ids[0]
+            del self._semantic_timestamps[0]
+
     def clear_expired(self) -> int:
         """Removes all expired cache entries"""
         deleted_count = 0
         current_time = time.time()
 
         try:
-            for filename in os.listdir(self.cache_dir):
-                if not filename.endswith('.json'):
-                    continue
-
-                cache_path = os.path.join(self.cache_dir, filename)
-                try:
-                    with open(cache_path, 'r', encoding='utf-8') as f:
-                        cache_data = json.load(f)
+            with os.scandir(self.cache_dir) as entries:
+                for entry in entries:
+                    if not entry.name.endswith('.json'):
+                        continue
 
-                    timestamp = cache_data.get('timestamp', 0)
-                    if current_time - timestamp > self.ttl:
-                        os.remove(cache_path)
-                        deleted_count += 1
-                except Exception as e:
-                    self.logger.warning(f"Ошибка при обработке {filename}: {e}")
                     try:
-                        os.remove(cache_path)
-                        deleted_count += 1
-                    except:
-                        pass
+                        if current_time - entry.stat().st_mtime > self.ttl:
+                            os.remove(entry.path)
+                            deleted_count += 1
+                    except Exception as e:
+                        self.logger.warning(f"Ошибка при обработке {entry.name}: {e}")
 
             if deleted_count > 0:
                 self.logger.info(f"Удалено {deleted_count} устаревших записей кэша")
@@ -132,6 +292,15 @@ class CacheManager:
                 except Exception as e:
                     self.logger.warning(f"Ошибка при удалении {filename}: {e}")
 
+            with self._memory_lock:
+                self._memory.clear()
+            with self._semantic_lock:
+                self._semantic_embeddings = np.empty((0, 0), dtype=np.float32)
+                self._semantic_answers = []
+                self._semantic_context_hashes = []
+                self._semantic_user_ids = []
+                self._semantic_timestamps = []
+
             self.logger.info(f"Весь кэш очищен. Удалено {deleted_count} записей")
 
         except Exception as e:
@@ -147,23 +316,16 @@ class CacheManager:
         total_size = 0
 
         try:
-            for filename in os.listdir(self.cache_dir):
-                if not filename.endswith('.json'):
-                    continue
-
-                cache_path = os.path.join(self.cache_dir, filename)
-                total_count += 1
-                total_size += os.path.getsize(cache_path)
-
-                try:
-                    with open(cache_path, 'r', encoding='utf-8') as f:
-                        cache_data = json.load(f)
-
-                    timestamp = cache_data.get('timestamp', 0)
-                    if current_time - timestamp > self.ttl:
+            with os.scandir(self.cache_dir) as entries:
+                for entry in entries:
+                    if not entry.name.endswith('.json'):
+                        continue
+
+                    stat = entry.stat()
+                    total_count += 1
+                    total_size += stat.st_size
+                    if current_time - stat.st_mtime > self.ttl:
                         expired_count += 1
-                except:
-                    expired_count += 1
 
             stats = {
                 'total_entries': total_count,
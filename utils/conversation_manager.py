@@ -1,9 +1,23 @@
+import atexit
 import json
 import os
-from typing import List, Dict, Optional
-from collections import defaultdict
+import queue
+import threading
+import time
+from collections import deque
+from typing import List, Dict, Optional, Tuple
 from utils.logger_config import setup_logger
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Process-wide instances handed out by ConversationManager.get_shared, keyed by their settings;
+# two managers over one directory would race on its files
+_shared_instances: Dict[tuple, "ConversationManager"] = {}
+_shared_lock = threading.Lock()
+
 class ConversationManager:
     """Manager for handling user conversation history"""
 
@@ -11,81 +25,210 @@ class ConversationManager:
         self.logger = setup_logger("conversation_manager")
         self.storage_dir = os.getenv("CONVERSATIONS_DIR", storage_dir)
         self.max_history = max_history
-        self.conversations: Dict[int, List[Dict[str, str]]] = defaultdict(list)
+        # Histories are read from disk on first access to a user, not all at startup
+        # Each history is a deque capped at max_history exchanges, so trimming never copies it
+        self.conversations: Dict[int, "deque[Dict[str, str]]"] = {}
+        # Each user's history is an append-only user_{id}.jsonl log, rewritten with just the kept messages
+        # once it holds more than twice as many lines
+        self._file_lines: Dict[int, int] = {}
+
+        # Appends and clears are queued as (user_id, line or None for a clear) and written by a background thread,
+        # which gathers them for flush_interval seconds and writes each user's log once per batch
+        self.flush_interval = 0.2
+        self._write_queue: "queue.Queue[Optional[Tuple[int, Optional[bytes]]]]" = queue.Queue()
+        self._pending_writes: Dict[int, int] = {}
+        self._lock = threading.Lock()
 
         os.makedirs(self.storage_dir, exist_ok=True)
-        self._load_conversations()
+        self._writer = threading.Thread(target=self._writer_loop, name="conversation-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
         self.logger.info(f"ConversationManager инициализирован (max_history: {max_history})")
 
+    @classmethod
+    def get_shared(cls, storage_dir: str = "conversations", max_history: int = 10) -> "ConversationManager":
+        """Returns the process-wide ConversationManager with these settings, creating it on first use"""
+        key = (os.path.abspath(os.getenv("CONVERSATIONS_DIR", storage_dir)), max_history)
+        with _shared_lock:
+            instance = _shared_instances.get(key)
+            if instance is None:
+                instance = cls(storage_dir, max_history)
+                _shared_instances[key] = instance
+            return instance
+
     def _get_conversation_file(self, user_id: int) -> str:
         """Returns the path to the history file for a user"""
+        return os.path.join(self.storage_dir, f"user_{user_id}.jsonl")
+
+    def _get_legacy_file(self, user_id: int) -> str:
+        """Returns the path to the whole-history JSON file used by older versions"""
         return os.path.join(self.storage_dir, f"user_{user_id}.json")
 
-    def _load_conversations(self):
-        """Loads conversation histories from files"""
+    def _encode(self, message: Dict[str, str]) -> bytes:
+        """Encodes a message as one JSONL line"""
+        if orjson is not None:
+            return orjson.dumps(message) + b"\n"
+        return (json.dumps(message, ensure_ascii=False) + "\n").encode('utf-8')
+
+    def _decode(self, data: bytes):
+        """Decodes one JSONL line or a whole JSON file"""
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+
+    def _new_history(self) -> "deque[Dict[str, str]]":
+        """Returns an empty history holding at most max_history exchanges"""
+        return deque(maxlen=self.max_history * 2)
+
+    def _push(self, history: "deque[Dict[str, str]]", message: Dict[str, str]) -> bool:
+        """Appends a message, dropping the oldest exchange when a user message overflows the history; True if trimmed"""
+        trimmed = message['role'] == 'user' and len(history) >= history.maxlen > 0
+        if trimmed:
+            history.popleft()
+            history.popleft()
+        history.append(message)
+        return trimmed
+
+    def _load_conversation(self, user_id: int) -> "deque[Dict[str, str]]":
+        """Returns the history of a user, replaying its log from disk on first access"""
+        history = self.conversations.get(user_id)
+        if history is not None:
+            return history
+
+        history = self._new_history()
+        self.conversations[user_id] = history
+        filepath = self._get_conversation_file(user_id)
+        legacy_filepath = self._get_legacy_file(user_id)
         try:
-            for filename in os.listdir(self.storage_dir):
-                if not filename.startswith("user_") or not filename.endswith(".json"):
-                    continue
+            if os.path.exists(filepath):
+                with open(filepath, 'rb') as f:
+                    lines = [line for line in f.read().splitlines() if line.strip()]
+                for number, line in enumerate(lines, 1):
+                    try:
+                        self._push(history, self._decode(line))
+                    except ValueError:
+                        # A line torn by a crash mid-append; the lines around it are still valid
+                        self.logger.warning(f"Пропущена поврежденная строка {number} в истории user_id {user_id}")
+                self._file_lines[user_id] = len(lines)
+            elif os.path.exists(legacy_filepath):
+                with open(legacy_filepath, 'rb') as f:
+                    history.extend(self._decode(f.read()).get('messages', []))
+                self._rewrite_conversation(user_id, history)
+                os.remove(legacy_filepath)
+                self.logger.info(f"История user_id {user_id} перенесена в {filepath}")
+        except Exception as e:
+            self.logger.warning(f"Ошибка при загрузке истории для user_id {user_id}: {e}")
+        return history
+
+    def _rewrite_conversation(self, user_id: int, history: "deque[Dict[str, str]]"):
+        """Rewrites a user's log with only the kept history, atomically"""
+        filepath = self._get_conversation_file(user_id)
+        tmp_filepath = f"{filepath}.tmp"
+        with open(tmp_filepath, 'wb') as f:
+            f.write(b"".join(self._encode(message) for message in history))
+        os.replace(tmp_filepath, filepath)
+        self._file_lines[user_id] = len(history)
 
-                filepath = os.path.join(self.storage_dir, filename)
+    def _enqueue(self, user_id: int, line: Optional[bytes]):
+        """Queues a log line (or a clear, when line is None) for the writer thread; called with the lock held"""
+        self._pending_writes[user_id] = self._pending_writes.get(user_id, 0) + 1
+        self._write_queue.put((user_id, line))
+
+    def _writer_loop(self):
+        """Writer thread: collects queued changes for flush_interval seconds, then writes them"""
+        stopping = False
+        while not stopping:
+            item = self._write_queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while (remaining := deadline - time.monotonic()) > 0:
                 try:
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                        user_id = data.get('user_id')
-                        messages = data.get('messages', [])
-                        if user_id:
-                            self.conversations[user_id] = messages
-                except Exception as e:
-                    self.logger.warning(f"Ошибка при загрузке истории из {filename}: {e}")
-
-            self.logger.info(f"Загружено историй для {len(self.conversations)} пользователей")
-        except Exception as e:
-            self.logger.error(f"Ошибка при загрузке историй: {e}", exc_info=True)
+                    item = self._write_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._write_batch(batch)
 
-    def _save_conversation(self, user_id: int):
-        """Saves conversation history for a user"""
-        try:
+    def _write_batch(self, batch: List[Tuple[int, Optional[bytes]]]):
+        """Applies a batch of queued changes with one append per user, compacting logs that grew too long"""
+        changes: Dict[int, Tuple[bool, List[bytes]]] = {}
+        for user_id, line in batch:
+            cleared, lines = changes.get(user_id, (False, []))
+            changes[user_id] = (True, []) if line is None else (cleared, lines + [line])
+
+        for user_id, (cleared, lines) in changes.items():
             filepath = self._get_conversation_file(user_id)
-            data = {
-                'user_id': user_id,
-                'messages': self.conversations[user_id]
-            }
+            try:
+                if cleared and os.path.exists(filepath):
+                    os.remove(filepath)
+                    self._file_lines[user_id] = 0
+                if lines:
+                    with open(filepath, 'ab') as f:
+                        f.write(b"".join(lines))
+                    self._file_lines[user_id] = self._file_lines.get(user_id, 0) + len(lines)
+                self.logger.debug(f"История сохранена для user_id {user_id}")
+            except Exception as e:
+                self.logger.error(f"Ошибка при сохранении истории для user_id {user_id}: {e}", exc_info=True)
 
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+        with self._lock:
+            for user_id, _ in batch:
+                self._pending_writes[user_id] -= 1
+            # A log is compacted only when none of its messages are still queued, so the snapshot matches the file
+            to_compact = [
+                (user_id, list(self.conversations.get(user_id, ())))
+                for user_id in changes
+                if self._file_lines.get(user_id, 0) > self.max_history * 4 and not self._pending_writes[user_id]
+            ]
+        for user_id, history in to_compact:
+            try:
+                self._rewrite_conversation(user_id, history)
+            except Exception as e:
+                self.logger.error(f"Ошибка при сохранении истории для user_id {user_id}: {e}", exc_info=True)
 
-            self.logger.debug(f"История сохранена для user_id {user_id}")
-        except Exception as e:
-            self.logger.error(f"Ошибка при сохранении истории для user_id {user_id}: {e}", exc_info=True)
+    def close(self):
+        """Writes out all queued changes and stops the writer thread"""
+        if self._writer.is_alive():
+            self._write_queue.put(None)
+            self._writer.join()
 
     def add_user_message(self, user_id: int, message: str):
         """Adds user message to history"""
-        self.conversations[user_id].append({
+        entry = {
             "role": "user",
             "content": message
-        })
+        }
 
-        if len(self.conversations[user_id]) > self.max_history * 2:
-            self.conversations[user_id] = self.conversations[user_id][2:]
+        history = self._load_conversation(user_id)
+        with self._lock:
+            trimmed = self._push(history, entry)
+            self._enqueue(user_id, self._encode(entry))
+        if trimmed:
             self.logger.debug(f"История обрезана для user_id {user_id}")
 
-        self._save_conversation(user_id)
         self.logger.debug(f"Добавлено сообщение пользователя для user_id {user_id}")
 
     def add_assistant_message(self, user_id: int, message: str):
         """Adds assistant response to history"""
-        self.conversations[user_id].append({
+        entry = {
             "role": "assistant",
             "content": message
-        })
+        }
+
+        history = self._load_conversation(user_id)
+        with self._lock:
+            self._push(history, entry)
+            self._enqueue(user_id, self._encode(entry))
 
-        self._save_conversation(user_id)
         self.logger.debug(f"Добавлен ответ ассистента для user_id {user_id}")
 
     def get_history(self, user_id: int, limit: Optional[int] = None) -> List[Dict[str, str]]:
         """Retrieves conversation history for a user"""
-        history = self.conversations.get(user_id, [])
+        history = list(self._load_conversation(user_id))
 
         if limit:
             history = history[-limit:]
@@ -96,12 +239,11 @@ class ConversationManager:
     def clear_history(self, user_id: int) -> bool:
         """Clears conversation history for a user"""
         try:
-            if user_id in self.conversations:
-                self.conversations[user_id] = []
-
-                filepath = self._get_conversation_file(user_id)
-                if os.path.exists(filepath):
-                    os.remove(filepath)
+            filepath = self._get_conversation_file(user_id)
+            if self._load_conversation(user_id) or os.path.exists(filepath):
+                with self._lock:
+                    self.conversations[user_id] = self._new_history()
+                    self._enqueue(user_id, None)
 
                 self.logger.info(f"История очищена для user_id {user_id}")
                 return True
@@ -114,7 +256,7 @@ class ConversationManager:
 
     def get_stats(self, user_id: int) -> Dict[str, int]:
         """Retrieves statistics for user's history"""
-        history = self.conversations.get(user_id, [])
+        history = self._load_conversation(user_id)
         user_messages = sum(1 for msg in history if msg['role'] == 'user')
         assistant_messages = sum(1 for msg in history if msg['role'] == 'assistant')
 
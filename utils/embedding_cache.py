@@ -0,0 +1,144 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+import numpy as np
+from utils.logger_config import setup_logger
+
+# Process-wide instances handed out by EmbeddingCache.get_shared, keyed by their settings
+_shared_instances: Dict[tuple, "EmbeddingCache"] = {}
+_shared_lock = threading.Lock()
+
+class EmbeddingCache:
+    """Two-tier cache of text embeddings: in-memory LRU in front of a SQLite file, keyed by model and text"""
+
+    def __init__(self, cache_dir: str = "embeddings_cache", max_memory_entries: int = 2048,
+                 ttl: int = 30 * 24 * 3600, fuzzy: bool = False, fuzzy_max_distance: int = 3,
+                 fuzzy_min_words: int = 16, max_fuzzy_entries: int = 1024):
+        self.logger = setup_logger("embedding_cache")
+        self.cache_dir = os.getenv("EMBEDDING_CACHE_DIR", cache_dir)
+        self.ttl = ttl
+        self.max_memory_entries = max_memory_entries
+        # float32 arrays (6 KB per 1536-dim embedding instead of ~49 KB as a list of floats); callers get list copies
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Fuzzy tier (opt-in): reuses the embedding of a recent text whose 64-bit simhash is within
+        # fuzzy_max_distance bits. Short texts are excluded, their simhashes collide too easily
+        self.fuzzy = fuzzy
+        self.fuzzy_max_distance = fuzzy_max_distance
+        self.fuzzy_min_words = fuzzy_min_words
+        self.max_fuzzy_entries = max_fuzzy_entries
+        self._simhashes: "OrderedDict[str, int]" = OrderedDict()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(self.cache_dir, "embeddings.sqlite3"), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._db.commit()
+        self.logger.info(f"EmbeddingCache инициализирован (dir: {self.cache_dir}, fuzzy: {fuzzy})")
+
+    @classmethod
+    def get_shared(cls, cache_dir: str = "embeddings_cache", max_memory_entries: int = 2048,
+                   ttl: int = 30 * 24 * 3600, fuzzy: bool = False, fuzzy_max_distance: int = 3,
+                   fuzzy_min_words: int = 16, max_fuzzy_entries: int = 1024) -> "EmbeddingCache":
+        """Returns the process-wide EmbeddingCache with these settings, creating it on first use, so every service
+        shares one LRU and one SQLite connection"""
+        key = (os.path.abspath(os.getenv("EMBEDDING_CACHE_DIR", cache_dir)), max_memory_entries, ttl, fuzzy,
+               fuzzy_max_distance, fuzzy_min_words, max_fuzzy_entries)
+        with _shared_lock:
+            instance = _shared_instances.get(key)
+            if instance is None:
+                instance = cls(cache_dir, max_memory_entries, ttl, fuzzy, fuzzy_max_distance, fuzzy_min_words,
+                               max_fuzzy_entries)
+                _shared_instances[key] = instance
+            return instance
+
+    def _make_key(self, model: str, text: str) -> str:
+        """Returns the cache key of a text embedded with a model"""
+        return hashlib.sha256(f"{model}\0{text}".encode('utf-8')).hexdigest()
+
+    def _simhash(self, words: List[str]) -> int:
+        """Computes a 64-bit simhash over word bigrams"""
+        votes = np.zeros(64, dtype=np.int32)
+        bits = np.arange(64, dtype=np.uint64)
+        for shingle in zip(words, words[1:]):
+            digest = hashlib.blake2b(" ".join(shingle).encode('utf-8'), digest_size=8).digest()
+            value = np.uint64(int.from_bytes(digest, 'little'))
+            votes += np.where((value >> bits) & np.uint64(1), 1, -1).astype(np.int32)
+        return int(sum(1 << i for i in range(64) if votes[i] > 0))
+
+    def _words(self, text: str) -> List[str]:
+        """Splits text into lowercase words for simhashing"""
+        return re.findall(r"\w+", text.lower())
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        """Returns a cached embedding, checking memory, then disk, then (if enabled) near-duplicate texts"""
+        key = self._make_key(model, text)
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self._memory.move_to_end(key)
+                return embedding.tolist()
+
+            row = self._db.execute("SELECT embedding, created_at FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                if time.time() - row[1] <= self.ttl:
+                    embedding = np.frombuffer(row[0], dtype=np.float32)
+                    self._remember(key, embedding)
+                    self.logger.debug(f"Эмбеддинг найден в дисковом кэше ({key[:16]}...)")
+                    return embedding.tolist()
+                self._db.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+                self._db.commit()
+
+            if self.fuzzy:
+                return self._fuzzy_get(text)
+        return None
+
+    def _fuzzy_get(self, text: str) -> Optional[List[float]]:
+        """Returns the embedding of a recent near-duplicate text, if any; called with the lock held"""
+        words = self._words(text)
+        if len(words) < self.fuzzy_min_words:
+            return None
+        simhash = self._simhash(words)
+        for key, other in reversed(self._simhashes.items()):
+            if bin(simhash ^ other).count('1') <= self.fuzzy_max_distance and key in self._memory:
+                self.logger.debug(f"Эмбеддинг переиспользован для почти совпадающего текста ({key[:16]}...)")
+                return self._memory[key].tolist()
+        return None
+
+    def _remember(self, key: str, embedding: np.ndarray):
+        """Puts an embedding into the in-memory LRU; called with the lock held"""
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def set(self, model: str, text: str, embedding: List[float]):
+        """Stores an embedding in memory and on disk"""
+        if not embedding:
+            return
+        key = self._make_key(model, text)
+        vector = np.asarray(embedding, dtype=np.float32)
+        blob = vector.tobytes()
+        with self._lock:
+            self._remember(key, vector)
+            if self.fuzzy:
+                words = self._words(text)
+                if len(words) >= self.fuzzy_min_words:
+                    self._simhashes[key] = self._simhash(words)
+                    if len(self._simhashes) > self.max_fuzzy_entries:
+                        self._simhashes.popitem(last=False)
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, embedding, created_at) VALUES (?, ?, ?)",
+                    (key, blob, time.time())
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                self.logger.error(f"Ошибка при сохранении эмбеддинга в кэш: {e}")
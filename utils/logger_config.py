@@ -1,43 +1,60 @@
+import atexit
+import functools
 import logging
 import os
-from logging.handlers import RotatingFileHandler
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from dotenv import load_dotenv
 
 load_dotenv()
 
-def setup_logger(name: str = "bot") -> logging.Logger:
-    """Sets up logger with file and console output"""
-    log_level = os.getenv("LOG_LEVEL", "INFO").upper()
-    log_file = os.getenv("LOG_FILE", "bot.log")
-
-    logger = logging.getLogger(name)
-    logger.setLevel(getattr(logging, log_level, logging.INFO))
+LOG_LEVEL = getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO)
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+FORMATTER = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
 
-    if logger.handlers:
-        return logger
-
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
+@functools.lru_cache(maxsize=None)
+def _get_log_queue() -> "queue.Queue[logging.LogRecord]":
+    """Returns the queue shared by all loggers, starting the listener thread that writes it to console and file"""
+    handlers = []
 
     console_handler = logging.StreamHandler()
-    console_handler.setLevel(getattr(logging, log_level, logging.INFO))
-    console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
+    console_handler.setLevel(LOG_LEVEL)
+    console_handler.setFormatter(FORMATTER)
+    handlers.append(console_handler)
 
     try:
+        # delay=True: the file is opened by the listener thread on the first record
         file_handler = RotatingFileHandler(
-            log_file,
+            LOG_FILE,
             maxBytes=10*1024*1024,
             backupCount=5,
-            encoding='utf-8'
+            encoding='utf-8',
+            delay=True
         )
-        file_handler.setLevel(getattr(logging, log_level, logging.INFO))
-        file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        file_handler.setLevel(LOG_LEVEL)
+        file_handler.setFormatter(FORMATTER)
+        handlers.append(file_handler)
     except Exception as e:
-        logger.warning(f"Не удалось создать файловый обработчик: {e}")
+        logging.getLogger(__name__).warning(f"Не удалось создать файловый обработчик: {e}")
+
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return log_queue
+
+@functools.lru_cache(maxsize=None)
+def setup_logger(name: str = "bot") -> logging.Logger:
+    """Sets up logger with file and console output; configured once per name, later calls return the same logger"""
+    logger = logging.getLogger(name)
+    logger.setLevel(LOG_LEVEL)
+
+    # QueueHandler still formats the message in the calling thread; only the console and file I/O moves to the listener
+    logger.addHandler(QueueHandler(_get_log_queue()))
+    logger.propagate = False
 
     return logger
 
@@ -1,12 +1,59 @@
 """Query Router for Modular RAG - automatically determines query type and selects optimal search strategy"""
 
-from typing import Dict, List, Literal
+import functools
+import re
+import threading
+from typing import Dict, List, Literal, Optional, Tuple
 from enum import Enum
+import numpy as np
 from utils.logger_config import setup_logger
 
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
 logger = setup_logger("query_router")
 
 
+def _score_batch_kernel(data: np.ndarray, offsets: np.ndarray, transitions: np.ndarray, outputs: np.ndarray,
+                        fallback_index: int, result: np.ndarray):
+    """Classifies every query of a packed UTF-8 buffer with the byte-level automaton, one query per parallel iteration"""
+    for query_index in numba.prange(len(offsets) - 1):
+        masks = np.zeros(outputs.shape[1], dtype=np.int64)
+        state = 0
+        for position in range(offsets[query_index], offsets[query_index + 1]):
+            state = transitions[state, data[position]]
+            for type_index in range(masks.shape[0]):
+                masks[type_index] |= outputs[state, type_index]
+
+        best_index = fallback_index
+        best_score = 0
+        for type_index in range(masks.shape[0]):
+            mask = masks[type_index]
+            score = 0
+            while mask:
+                mask &= mask - 1
+                score += 1
+            if score > best_score:
+                best_score = score
+                best_index = type_index
+        result[query_index] = best_index
+
+
+_score_batch = numba.njit(parallel=True)(_score_batch_kernel) if numba is not None else None
+
+
 class QueryType(Enum):
     """Query types for classification"""
     FACTUAL = "factual"
@@ -26,6 +73,12 @@ class SearchStrategy(Enum):
 class QueryRouter:
     """Query router for Modular RAG - analyzes queries and selects optimal search strategy"""
 
+    __slots__ = (
+        'keywords', 'strategy_configs', 'type_to_strategy',
+        '_query_types', '_keyword_lists', '_hyperscan', '_automaton', '_patterns', '_byte_automaton',
+        '_classify_folded', '_route_templates', '_explanations'
+    )
+
     def __init__(self):
         self.keywords = {
             QueryType.FACTUAL: [
@@ -68,6 +121,10 @@ class QueryRouter:
             }
         }
 
+        # Scores are kept in a list indexed by position in QueryType, so ties still go to the earliest type
+        self._query_types = list(QueryType)
+        self._index_keywords()
+
         self.type_to_strategy = {
             QueryType.FACTUAL: SearchStrategy.PRECISE,
             QueryType.ANALYTICAL: SearchStrategy.BROAD,
@@ -76,43 +133,204 @@ class QueryRouter:
             QueryType.COMPARISON: SearchStrategy.COMPREHENSIVE
         }
 
+        # Classification depends only on the query text, so repeated queries skip the keyword scan.
+        # Classifications are cached by casefolded query, so queries differing only in case share an entry
+        self._classify_folded = functools.lru_cache(maxsize=1024)(self._classify)
+        self._build_route_templates()
+
+    def _build_route_templates(self):
+        """Precomputes the routing result of every query type, all but the query itself, and its explanation
+        (keyed by query type value), which does not depend on the query at all"""
+        self._route_templates = {}
+        self._explanations = {}
+        for query_type in QueryType:
+            strategy = self.type_to_strategy[query_type]
+            config = self.strategy_configs[strategy]
+            template = {
+                'query_type': query_type.value,
+                'strategy': strategy.value,
+                'top_k': config['top_k'],
+                'similarity_threshold': config['similarity_threshold'],
+                'description': config['description']
+            }
+            self._route_templates[query_type] = template
+            self._explanations[query_type.value] = '\n'.join((
+                "📊 Query Routing Analysis:",
+                f"• Query Type: {template['query_type']}",
+                f"• Strategy: {template['strategy']}",
+                f"• Top K: {template['top_k']} documents",
+                f"• Similarity Threshold: {template['similarity_threshold']}",
+                f"• Description: {template['description']}"
+            ))
+
+    def _index_keywords(self):
+        """Lays out the keywords as lists parallel to _query_types and builds the matchers over them"""
+        self._keyword_lists = [
+            [keyword.casefold() for keyword in self.keywords.get(query_type, [])] for query_type in self._query_types
+        ]
+        self._hyperscan = self._build_hyperscan()
+        self._automaton = self._build_automaton()
+        self._patterns = self._build_patterns()
+        # Byte-level automaton for classify_batch, built on its first use
+        self._byte_automaton: Optional[Tuple[np.ndarray, np.ndarray]] = None
+
+    def _build_hyperscan(self) -> Optional[Tuple["hyperscan.Database", List[Tuple[int, int]], threading.Lock]]:
+        """Compiles all keywords into one Hyperscan block-mode database, as (database, pattern id -> (type index, bit),
+        lock serializing scans over its scratch space); None if hyperscan is not installed"""
+        if hyperscan is None:
+            return None
+        keywords = [
+            (keyword, (index, 1 << bit))
+            for index, type_keywords in enumerate(self._keyword_lists)
+            for bit, keyword in enumerate(type_keywords)
+            if keyword
+        ]
+        if not keywords:
+            return None
+        database = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+        database.compile(
+            expressions=[keyword.encode('utf-8') for keyword, _ in keywords],
+            ids=list(range(len(keywords))),
+            elements=len(keywords),
+            flags=0,
+            literal=True
+        )
+        return database, [match for _, match in keywords], threading.Lock()
+
+    def _build_automaton(self):
+        """Builds an Aho-Corasick automaton mapping every keyword to (type index, its bit within the type);
+        None if pyahocorasick is not installed"""
+        if ahocorasick is None:
+            return None
+        automaton = ahocorasick.Automaton()
+        for index, keywords in enumerate(self._keyword_lists):
+            for bit, keyword in enumerate(keywords):
+                automaton.add_word(keyword, (index, 1 << bit))
+        automaton.make_automaton()
+        return automaton
+
+    def _build_patterns(self) -> List[Tuple[int, "re.Pattern", int]]:
+        """Compiles one alternation per query type for when pyahocorasick is not installed, as (type index, pattern,
+        highest score any later type can reach), types with the most keywords first.
+        The lookahead matches at every position, so overlapping keywords of a type are all found; longest first"""
+        keyword_sets = [sorted(set(keywords), key=len, reverse=True) for keywords in self._keyword_lists]
+        order = sorted(range(len(keyword_sets)), key=lambda index: len(keyword_sets[index]), reverse=True)
+        patterns = []
+        for position, index in enumerate(order):
+            alternation = '|'.join(map(re.escape, keyword_sets[index])) or r'(?!)'
+            remaining = len(keyword_sets[order[position + 1]]) if position + 1 < len(order) else 0
+            patterns.append((index, re.compile(f'(?=({alternation}))'), remaining))
+        return patterns
+
+    def _build_byte_automaton(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Builds a dense Aho-Corasick DFA over the UTF-8 bytes of the keywords: (state x byte -> state transitions,
+        state x type keyword bitmasks matched on entering the state, fail-link outputs included)"""
+        children: List[Dict[int, int]] = [{}]
+        outputs = [[0] * len(self._query_types)]
+        for index, keywords in enumerate(self._keyword_lists):
+            for bit, keyword in enumerate(keywords):
+                state = 0
+                for byte in keyword.encode('utf-8'):
+                    if byte not in children[state]:
+                        children[state][byte] = len(children)
+                        children.append({})
+                        outputs.append([0] * len(self._query_types))
+                    state = children[state][byte]
+                outputs[state][index] |= 1 << bit
+
+        transitions = np.zeros((len(children), 256), dtype=np.int32)
+        for byte, child in children[0].items():
+            transitions[0, byte] = child
+        fail = [0] * len(children)
+        queue = list(children[0].values())
+        for state in queue:
+            transitions[state] = transitions[fail[state]]
+            for byte, child in children[state].items():
+                fail[child] = transitions[fail[state], byte] if state else 0
+                outputs[child] = [own | inherited for own, inherited in zip(outputs[child], outputs[fail[child]])]
+                transitions[state, byte] = child
+                queue.append(child)
+        return transitions, np.asarray(outputs, dtype=np.int64)
+
+    def classify_batch(self, queries: List[str]) -> np.ndarray:
+        """Classifies many queries at once; returns int8 positions in QueryType order (list(QueryType)[i]).
+        Runs as a parallel Numba kernel when numba is installed, otherwise query by query"""
+        if _score_batch is None:
+            return np.fromiter(
+                (self._query_types.index(self.classify_query(query)) for query in queries),
+                dtype=np.int8, count=len(queries)
+            )
+
+        if self._byte_automaton is None:
+            self._byte_automaton = self._build_byte_automaton()
+        transitions, outputs = self._byte_automaton
+
+        encoded = [query.casefold().encode('utf-8') for query in queries]
+        data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(query) for query in encoded], out=offsets[1:])
+        result = np.empty(len(queries), dtype=np.int8)
+        _score_batch(data, offsets, transitions, outputs, self._query_types.index(QueryType.ANALYTICAL), result)
+        logger.info("Пакетно классифицировано запросов: %d", len(queries))
+        return result
+
+    def cache_clear(self):
+        """Rebuilds the keyword matchers and drops cached classifications and routes, e.g. after changing keywords or strategy configs"""
+        self._index_keywords()
+        self._classify_folded.cache_clear()
+        self._build_route_templates()
+
     def classify_query(self, query: str) -> QueryType:
         """Classifies query by type using keyword matching"""
-        query_lower = query.lower()
-        scores = {query_type: 0 for query_type in QueryType}
+        return self._classify_folded(query.casefold())
+
+    def _classify(self, query_folded: str) -> QueryType:
+        """Classifies an already casefolded query"""
+        if self._hyperscan is not None:
+            # Hyperscan reports every keyword occurrence in one scan; bits and popcount as with the automaton below
+            database, matches, lock = self._hyperscan
+            masks = [0] * len(self._query_types)
 
-        for query_type, keywords in self.keywords.items():
-            for keyword in keywords:
-                if keyword in query_lower:
-                    scores[query_type] += 1
+            def on_match(pattern_id, start, end, flags, context):
+                index, bit = matches[pattern_id]
+                masks[index] |= bit
 
-        max_score = max(scores.values())
+            with lock:
+                database.scan(query_folded.encode('utf-8'), match_event_handler=on_match)
+            scores = [mask.bit_count() for mask in masks]
+        elif self._automaton is not None:
+            # One pass over the query finds every keyword occurrence; repeats set the same bit, so a type's score
+            # is the popcount of its mask: the number of distinct keywords found
+            masks = [0] * len(self._query_types)
+            for _, (index, bit) in self._automaton.iter(query_folded):
+                masks[index] |= bit
+            scores = [mask.bit_count() for mask in masks]
+        else:
+            # Once the leader scores more than any remaining type has keywords, none of them can reach or tie it
+            scores = [0] * len(self._query_types)
+            for index, pattern, remaining in self._patterns:
+                scores[index] = len(set(pattern.findall(query_folded)))
+                if max(scores) > remaining:
+                    break
+
+        max_score = max(scores)
         if max_score == 0:
-            logger.info(f"Query '{query}' не классифицирован, используется ANALYTICAL")
+            logger.info("Query '%s' не классифицирован, используется ANALYTICAL", query_folded)
             return QueryType.ANALYTICAL
 
-        best_type = max(scores.items(), key=lambda x: x[1])[0]
-        logger.info(f"Query '{query}' классифицирован как {best_type.value}")
+        best_type = self._query_types[scores.index(max_score)]
+        logger.info("Query '%s' классифицирован как %s", query_folded, best_type.value)
         return best_type
 
     def route(self, query: str) -> Dict:
         """Determines optimal search strategy for query"""
         query_type = self.classify_query(query)
-        strategy = self.type_to_strategy[query_type]
-        config = self.strategy_configs[strategy]
-
-        result = {
-            'query': query,
-            'query_type': query_type.value,
-            'strategy': strategy.value,
-            'top_k': config['top_k'],
-            'similarity_threshold': config['similarity_threshold'],
-            'description': config['description']
-        }
+        result = {'query': query, **self._route_templates[query_type]}
 
+        # %-style arguments: the message is only formatted if INFO is enabled
         logger.info(
-            f"Routing: {query_type.value} -> {strategy.value} "
-            f"(top_k={config['top_k']}, threshold={config['similarity_threshold']})"
+            "Routing: %s -> %s (top_k=%s, threshold=%s)",
+            result['query_type'], result['strategy'], result['top_k'], result['similarity_threshold']
         )
 
         return result
@@ -120,17 +338,7 @@ class QueryRouter:
     def explain_routing(self, query: str) -> str:
         """Returns human-readable explanation of strategy selection"""
         routing_result = self.route(query)
-
-        explanation = (
-            f"📊 Query Routing Analysis:\n"
-            f"• Query Type: {routing_result['query_type']}\n"
-            f"• Strategy: {routing_result['strategy']}\n"
-            f"• Top K: {routing_result['top_k']} documents\n"
-            f"• Similarity Threshold: {routing_result['similarity_threshold']}\n"
-            f"• Description: {routing_result['description']}"
-        )
-
-        return explanation
+        return self._explanations[routing_result['query_type']]
 
 
 if __name__ == "__main__":
@@ -1,11 +1,86 @@
+import asyncio
+import email.utils
 import time
 import functools
-from typing import Callable, Any, Tuple, Type
-from logger_config import setup_logger
+import random
+from typing import Callable, Any, Optional, Tuple, Type
+from utils.logger_config import setup_logger
 import openai
 
 logger = setup_logger("retry_handler")
 
+# Warning logged for a retried exception, looked up along its MRO; other API errors get a generic message
+_RETRY_MESSAGES = {
+    openai.RateLimitError: "Rate limit достигнут.",
+    openai.APITimeoutError: "Timeout API.",
+    openai.APIConnectionError: "Ошибка подключения к API.",
+}
+
+def _retry_message(e: Exception) -> str:
+    """Returns the warning text for a retried exception"""
+    for cls in type(e).__mro__:
+        message = _RETRY_MESSAGES.get(cls)
+        if message is not None:
+            return message
+    return f"Ошибка API: {e}."
+
+# Exceptions retried by default
+_RETRYABLE_EXCEPTIONS = (
+    openai.APIError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.APITimeoutError,
+)
+
+# robust_call without a fallback re-raises instead of returning one
+_MISSING = object()
+
+# Client errors a retry cannot fix; 408, 409, 429 and 5xx stay retryable
+_NON_RETRYABLE_STATUS_CODES = frozenset({400, 401, 403, 404, 422})
+
+def _backoff_delays(max_retries: int, initial_delay: float, max_delay: float, exponential_base: float) -> Tuple[float, ...]:
+    """Returns the delay before each retry (the upper bound when jittered), fixed once per decorated function"""
+    if max_retries < 1:
+        raise ValueError(f"max_retries должен быть не меньше 1, получено {max_retries}")
+    return tuple(min(initial_delay * (exponential_base ** attempt), max_delay) for attempt in range(max_retries))
+
+def _retry_after(e: Exception) -> Optional[float]:
+    """Seconds a 429 response asks to wait (retry-after-ms or retry-after, in seconds or as an HTTP date); None if absent"""
+    response = getattr(e, 'response', None)
+    if response is None or getattr(response, 'status_code', None) != 429:
+        return None
+    headers = response.headers
+    try:
+        if 'retry-after-ms' in headers:
+            return max(float(headers['retry-after-ms']) / 1000, 0.0)
+        retry_after = headers.get('retry-after')
+        if retry_after is None:
+            return None
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            return max(email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+def _retry_delay(e: Exception, attempt: int, max_retries: int, delays: Tuple[float, ...],
+                 max_delay: float) -> Optional[float]:
+    """Decides on a caught retry_on error, shared by the sync and async retry loops: logs it and returns how long to
+    wait before the next attempt, or None if it must be re-raised (a client error a retry cannot fix, or the last attempt).
+    The wait is drawn uniformly from [0, scheduled delay] (full jitter), so clients that failed together do not retry
+    in lockstep; a rate-limited response's Retry-After (capped at max_delay) is used as is instead"""
+    if getattr(e, 'status_code', None) in _NON_RETRYABLE_STATUS_CODES:
+        logger.error(f"Ошибка API {e.status_code} (не повторяется): {e}")
+        return None
+    logger.warning(f"{_retry_message(e)} Попытка {attempt + 1}/{max_retries}")
+    if attempt + 1 >= max_retries:
+        logger.error(f"Все {max_retries} попыток исчерпаны. Последняя ошибка: {e}")
+        return None
+    retry_after = _retry_after(e)
+    delay = random.uniform(0, delays[attempt]) if retry_after is None else min(retry_after, max_delay)
+    logger.info(f"Ожидание {delay:.2f} секунд перед следующей попыткой...")
+    return delay
+
 class RetryHandler:
     """Retry handler for API calls with exponential backoff"""
 
@@ -15,59 +90,92 @@ class RetryHandler:
         initial_delay: float = 1.0,
         max_delay: float = 60.0,
         exponential_base: float = 2.0,
-        exceptions: Tuple[Type[Exception], ...] = (
-            openai.APIError,
-            openai.APIConnectionError,
-            openai.RateLimitError,
-            openai.APITimeoutError,
-        )
+        exceptions: Tuple[Type[Exception], ...] = _RETRYABLE_EXCEPTIONS
     ) -> Callable:
-        """Decorator for retries with exponential backoff"""
+        """Decorator for retries with exponential backoff and full jitter"""
+        delays = _backoff_delays(max_retries, initial_delay, max_delay, exponential_base)
+
         def decorator(func: Callable) -> Callable:
             @functools.wraps(func)
             def wrapper(*args, **kwargs) -> Any:
-                delay = initial_delay
-                last_exception = None
-
                 for attempt in range(max_retries):
                     try:
                         return func(*args, **kwargs)
                     except exceptions as e:
-                        last_exception = e
-
-                        if isinstance(e, openai.RateLimitError):
-                            logger.warning(f"Rate limit достигнут. Попытка {attempt + 1}/{max_retries}")
-                        elif isinstance(e, openai.APIConnectionError):
-                            logger.warning(f"Ошибка подключения к API. Попытка {attempt + 1}/{max_retries}")
-                        elif isinstance(e, openai.APITimeoutError):
-                            logger.warning(f"Timeout API. Попытка {attempt + 1}/{max_retries}")
-                        else:
-                            logger.warning(f"Ошибка API: {e}. Попытка {attempt + 1}/{max_retries}")
-
-                        if attempt < max_retries - 1:
-                            current_delay = min(delay * (exponential_base ** attempt), max_delay)
-                            logger.info(f"Ожидание {current_delay:.2f} секунд перед следующей попыткой...")
-                            time.sleep(current_delay)
+                        delay = _retry_delay(e, attempt, max_retries, delays, max_delay)
+                        if delay is None:
+                            raise
+                        time.sleep(delay)
                     except Exception as e:
                         logger.error(f"Неожиданная ошибка (не повторяется): {e}", exc_info=True)
                         raise
 
-                logger.error(f"Все {max_retries} попыток исчерпаны. Последняя ошибка: {last_exception}")
-                raise last_exception
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def async_exponential_backoff(
+        max_retries: int = 3,
+        initial_delay: float = 1.0,
+        max_delay: float = 60.0,
+        exponential_base: float = 2.0,
+        exceptions: Tuple[Type[Exception], ...] = _RETRYABLE_EXCEPTIONS
+    ) -> Callable:
+        """Decorator for coroutine functions: same retries as exponential_backoff, but waits with asyncio.sleep
+        so other tasks keep running on the event loop"""
+        delays = _backoff_delays(max_retries, initial_delay, max_delay, exponential_base)
+
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs) -> Any:
+                for attempt in range(max_retries):
+                    try:
+                        return await func(*args, **kwargs)
+                    except exceptions as e:
+                        delay = _retry_delay(e, attempt, max_retries, delays, max_delay)
+                        if delay is None:
+                            raise
+                        await asyncio.sleep(delay)
+                    except Exception as e:
+                        logger.error(f"Неожиданная ошибка (не повторяется): {e}", exc_info=True)
+                        raise
 
             return wrapper
         return decorator
 
     @staticmethod
-    def with_fallback(fallback_value: Any = None) -> Callable:
-        """Decorator for returning fallback value on error"""
+    def robust_call(
+        max_retries: int = 3,
+        initial_delay: float = 1.0,
+        max_delay: float = 60.0,
+        exponential_base: float = 2.0,
+        retry_on: Tuple[Type[Exception], ...] = _RETRYABLE_EXCEPTIONS,
+        fallback: Any = _MISSING,
+        fallback_on: Tuple[Type[Exception], ...] = (Exception,)
+    ) -> Callable:
+        """Decorator combining exponential_backoff and with_fallback: retries retry_on errors, then returns fallback for
+        fallback_on errors (re-raises them if no fallback is given)"""
+        retry = RetryHandler.exponential_backoff(max_retries, initial_delay, max_delay, exponential_base, retry_on)
+
         def decorator(func: Callable) -> Callable:
+            if fallback is _MISSING:
+                return retry(func)
+            return RetryHandler.with_fallback(fallback, fallback_on)(retry(func))
+        return decorator
+
+    @staticmethod
+    def with_fallback(fallback_value: Any = None,
+                      exceptions: Tuple[Type[Exception], ...] = (Exception,)) -> Callable:
+        """Decorator for returning fallback value on error; only the given exceptions are replaced, others propagate"""
+        def decorator(func: Callable) -> Callable:
+            name = func.__name__
+
             @functools.wraps(func)
             def wrapper(*args, **kwargs) -> Any:
                 try:
                     return func(*args, **kwargs)
-                except Exception as e:
-                    logger.error(f"Ошибка в {func.__name__}: {e}. Возвращаем fallback значение.", exc_info=True)
+                except exceptions as e:
+                    logger.error("Ошибка в %s: %s. Возвращаем fallback значение.", name, e, exc_info=True)
                     return fallback_value
             return wrapper
         return decorator